@@ -32,7 +32,8 @@ coverage = np.zeros((nrow,ncol,),dtype=int)
 obs_step = []
 
 skipped_obs = 0
-for weight in obs.weight_grid:
+for i in range( obs.length ):
+    weight = obs.get_weight_grid( i )
     #limit to obs the reach the surface
     if 0 not in [ k[2] for k in weight.keys() ]:
         skipped_obs += 1
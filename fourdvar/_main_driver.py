@@ -58,11 +58,12 @@ def cost_func( vector ):
     bg_vector = bg_unknown.get_vector()
     un_vector = unknown.get_vector()
     
-    bg_cost = 0.5 * np.sum( ( un_vector - bg_vector )**2 )
+    #sums are calculated in float64, whatever the precision of the vectors
+    bg_cost = 0.5 * np.sum( ( un_vector - bg_vector )**2, dtype='float64' )
     
     res_vector = residual.get_vector()
     wres_vector = w_residual.get_vector()
-    ob_cost = 0.5 * np.sum( res_vector * wres_vector )
+    ob_cost = 0.5 * np.sum( res_vector * wres_vector, dtype='float64' )
     cost = bg_cost + ob_cost
 
     unknown.cleanup()
@@ -145,7 +146,8 @@ def gradient_func( vector ):
     end_time = time.time()
     logger.info( 'gradient norm = {:} in {:}s'.format( np.linalg.norm(gradient),
                                                        int(end_time-start_time) ) )
-    return np.array( gradient )
+    #minimizer requires a float64 gradient
+    return np.array( gradient, dtype='float64' )
 
 def get_answer():
     """
@@ -15,7 +15,7 @@ from fourdvar.datadef.abstract._fourdvar_data import FourDVarData
 import fourdvar.util.netcdf_handle as ncf
 from fourdvar.util.archive_handle import get_archive_path
 import fourdvar.util.date_handle as dt
-from fourdvar.params.input_defn import inc_icon
+from fourdvar.params.input_defn import inc_icon, value_dtype
 
 import setup_logging
 logger = setup_logging.get_logger( __file__ )
@@ -32,6 +32,7 @@ class PhysicalAbstractData( FourDVarData ):
     ncols = None       #No. columns for all data
     spcs = None        #list of species for all data
     emis_unc = None    #dict of emis uncertainty values
+    emis_mask = None   #bool array [row, column], False = emis fixed at the prior (None = all True)
     
     if inc_icon is True:
         nlays_icon = None  #No. layers for icon data
@@ -39,6 +40,13 @@ class PhysicalAbstractData( FourDVarData ):
         #this class variable should be overloaded in children
         icon_units = 'NA'  #unit to attach to netCDF archive
 
+    #emis_unc & icon_unc stacked in UnknownData order (see get_unc_buffer)
+    unc_buffer = None
+    #( unc_buffer, emis_mask, active values ) last used by get_active
+    active_cache = None
+    #value_arr of the prior estimate (see set_prior)
+    prior_buffer = None
+    
     #these class variables should be overloaded in children
     archive_name = 'physical_abstract_data.ncf' #default archive filename
     emis_units = 'NA'  #unit to attach to netCDF archive
@@ -57,16 +65,18 @@ class PhysicalAbstractData( FourDVarData ):
         #params must all be set and not None (usally using cls.from_file)
         self.assert_params()
         
+        #all data is held in one contiguous buffer, icon & emis are views into it
+        self.value_arr = np.empty( self.get_size(), dtype=value_dtype )
+        self.icon, self.emis = self.get_views( self.value_arr )
+        
         if inc_icon is True:
             assert set( icon_dict.keys() ) == set( self.spcs ), 'invalid icon spcs.'
-            self.icon = {}
         
         assert set( emis_dict.keys() ) == set( self.spcs ), 'invalid emis spcs.'
-        self.emis = {}
         
         for spcs_name in self.spcs:
             if inc_icon is True:
-                icon_data = np.array( icon_dict[ spcs_name ] )
+                icon_data = np.asarray( icon_dict[ spcs_name ] )
                 
                 assert len( icon_data.shape ) == 3, 'icon dimensions invalid.'
                 inl,inr,inc = icon_data.shape
@@ -74,9 +84,9 @@ class PhysicalAbstractData( FourDVarData ):
                 assert inr == self.nrows, 'icon rows invalid.'
                 assert inc == self.ncols, 'icon columns invalid.'
                 
-                self.icon[ spcs_name ] = icon_data
+                self.icon[ spcs_name ][...] = icon_data
             
-            emis_data = np.array( emis_dict[ spcs_name ] )
+            emis_data = np.asarray( emis_dict[ spcs_name ] )
             
             assert len( emis_data.shape ) == 4, 'emis dimensions invalid.'            
             ent,enl,enr,enc = emis_data.shape
@@ -85,9 +95,160 @@ class PhysicalAbstractData( FourDVarData ):
             assert enr == self.nrows, 'emis rows invalid.'
             assert enc == self.ncols, 'emis columns invalid.'
             
-            self.emis[ spcs_name ] = emis_data
+            self.emis[ spcs_name ][...] = emis_data
         return None
     
+    @classmethod
+    def from_buffer( cls, value_arr ):
+        """
+        extension: create an instance that uses value_arr as its data buffer (no copy)
+        input: np.ndarray (1D, value_dtype, length get_size(), in UnknownData order)
+        output: PhysicalData
+        
+        eg: new_phys = datadef.PhysicalData.from_buffer( PhysicalData.zeros_buffer() )
+        
+        notes: changes to value_arr change the instance (and vice versa).
+        """
+        cls.assert_params()
+        assert isinstance( value_arr, np.ndarray ), 'buffer must be a numpy array.'
+        assert value_arr.shape == ( cls.get_size(), ), 'buffer size invalid.'
+        assert value_arr.dtype == np.dtype( value_dtype ), 'buffer dtype invalid.'
+        assert value_arr.flags[ 'C_CONTIGUOUS' ], 'buffer must be contiguous.'
+        newdata = cls.__new__( cls )
+        newdata.value_arr = value_arr
+        newdata.icon, newdata.emis = cls.get_views( value_arr )
+        return newdata
+    
+    @classmethod
+    def get_size( cls ):
+        """
+        extension: No. of values in a physical data buffer (same as UnknownData)
+        input: None
+        output: int
+        """
+        size = cls.nstep * cls.nlays_emis * cls.nrows * cls.ncols
+        if inc_icon is True:
+            size += cls.nlays_icon * cls.nrows * cls.ncols
+        return len( cls.spcs ) * size
+    
+    @classmethod
+    def zeros_buffer( cls ):
+        """
+        extension: new zero-filled physical data buffer
+        input: None
+        output: np.ndarray (1D, value_dtype, length get_size())
+        """
+        return np.zeros( cls.get_size(), dtype=value_dtype )
+    
+    @classmethod
+    def get_views( cls, value_arr ):
+        """
+        extension: split a physical data buffer into per-species views
+        input: np.ndarray (1D, length get_size())
+        output: ( icon_dict or None, emis_dict ) of views into value_arr
+        
+        notes: buffer is ordered by species, icon (if included) then emis.
+        """
+        emis_shape = ( cls.nstep, cls.nlays_emis, cls.nrows, cls.ncols, )
+        emis_len = int( np.prod( emis_shape ) )
+        if inc_icon is True:
+            icon_shape = ( cls.nlays_icon, cls.nrows, cls.ncols, )
+            icon_len = int( np.prod( icon_shape ) )
+            icon_dict = {}
+        else:
+            icon_dict = None
+        emis_dict = {}
+        i = 0
+        for spc in cls.spcs:
+            if inc_icon is True:
+                icon_dict[ spc ] = value_arr[ i:i+icon_len ].reshape( icon_shape )
+                i += icon_len
+            emis_dict[ spc ] = value_arr[ i:i+emis_len ].reshape( emis_shape )
+            i += emis_len
+        assert i == value_arr.size, 'buffer size invalid.'
+        return icon_dict, emis_dict
+    
+    @classmethod
+    def get_unc_buffer( cls ):
+        """
+        extension: uncertainty of every value as one buffer (UnknownData order)
+        input: None
+        output: np.ndarray (1D, length get_size())
+        
+        notes: emis_unc & icon_unc are replaced with views into the buffer,
+        it is only rebuilt if any of those arrays are replaced.
+        """
+        cls.assert_params()
+        buf = PhysicalAbstractData.unc_buffer
+        unc_list = cls.emis_unc.values()
+        if inc_icon is True:
+            unc_list += cls.icon_unc.values()
+        if buf is None or any( u.base is not buf for u in unc_list ):
+            buf = cls.zeros_buffer()
+            icon_unc, emis_unc = cls.get_views( buf )
+            for spc in cls.spcs:
+                if inc_icon is True:
+                    icon_unc[ spc ][...] = cls.icon_unc[ spc ]
+                emis_unc[ spc ][...] = cls.emis_unc[ spc ]
+            #set this abstract classes attribute, not calling child!
+            if inc_icon is True:
+                PhysicalAbstractData.icon_unc = icon_unc
+            PhysicalAbstractData.emis_unc = emis_unc
+            PhysicalAbstractData.unc_buffer = buf
+        return buf
+    
+    @classmethod
+    def get_active( cls ):
+        """
+        extension: which values of a physical buffer are controlled by unknowns
+        input: None
+        output: np.ndarray (1D bool, length get_size()) or None (every value is active)
+        
+        notes: emis values are inactive (fixed at the prior) where emis_unc is 0
+        or emis_mask is False, icon values are always active.
+        """
+        unc = cls.get_unc_buffer()
+        mask = cls.emis_mask
+        cache = PhysicalAbstractData.active_cache
+        if cache is None or cache[0] is not unc or cache[1] is not mask:
+            active = ( unc > 0 )
+            if mask is not None:
+                icon_active, emis_active = cls.get_views( active )
+                for spc in cls.spcs:
+                    emis_active[ spc ] &= np.asarray( mask, dtype=bool )
+            if active.all():
+                active = None
+            cache = ( unc, mask, active, )
+            PhysicalAbstractData.active_cache = cache
+        return cache[2]
+    
+    @classmethod
+    def set_prior( cls, prior ):
+        """
+        extension: record the prior estimate used by condition & uncondition
+        input: PhysicalData
+        output: None
+        
+        notes: aggregated unknowns are increments from the prior.
+        the prior buffer is shared, not copied.
+        """
+        assert prior.value_arr.size == cls.get_size(), 'prior size invalid.'
+        #set this abstract classes attribute, not calling child!
+        PhysicalAbstractData.prior_buffer = prior.value_arr
+        return None
+    
+    @classmethod
+    def get_prior_buffer( cls ):
+        """
+        extension: values of the prior estimate as one buffer (UnknownData order)
+        input: None
+        output: np.ndarray (1D, length get_size())
+        """
+        buf = PhysicalAbstractData.prior_buffer
+        assert buf is not None, 'prior estimate not set (see set_prior).'
+        assert buf.size == cls.get_size(), 'prior size invalid.'
+        return buf
+    
     def archive( self, path=None ):
         """
         extension: save a copy of data to archive/experiment directory
@@ -118,8 +279,11 @@ class PhysicalAbstractData( FourDVarData ):
         attr_dict[ 'VAR-LIST' ] = var_list
         dim_dict = { 'ROW': self.nrows, 'COL': self.ncols }
         
+        root_var = {}
+        if self.emis_mask is not None:
+            root_var[ 'MASK' ] = ( 'i4', ('ROW','COL',), self.emis_mask )
         root = ncf.create( path=save_path, attr=attr_dict, dim=dim_dict,
-                           is_root=True )
+                           var=root_var, is_root=True )
         
         if inc_icon is True:
             icon_dim = { 'LAY': self.nlays_icon }
@@ -171,6 +335,8 @@ class PhysicalAbstractData( FourDVarData ):
             icon_unc = ncf.get_variable( filename, unc_list, group='icon' )
         emis_dict = ncf.get_variable( filename, spcs_list, group='emis' )
         emis_unc = ncf.get_variable( filename, unc_list, group='emis' )
+        #optional MASK (ROW, COL), 0 = emissions fixed at the prior (eg: ocean)
+        emis_mask = ncf.get_variable( filename, [ 'MASK' ] ).get( 'MASK', None )
         
         for spc in spcs_list:
             if inc_icon is True:
@@ -204,12 +370,16 @@ class PhysicalAbstractData( FourDVarData ):
                 assert icon_unc[ spc ].shape == icon_dict[ spc ].shape, msg
                 assert ( icon_unc[ spc ] > 0 ).all(), msg
             assert emis_unc[ spc ].shape == emis_dict[ spc ].shape, msg
-            assert ( emis_unc[ spc ] > 0 ).all(), msg
+            #emis uncertainty of 0 fixes that value (no unknown)
+            assert ( emis_unc[ spc ] >= 0 ).all(), msg
+        if emis_mask is not None:
+            assert emis_mask.shape == ( erows, ecols, ), 'MASK must match (ROW, COL).'
+            emis_mask = ( np.asarray( emis_mask ) != 0 )
         
         #assign new param values.
-        par_name = ['tsec','nstep','nlays_emis','nrows','ncols','spcs','emis_unc']
-        par_val = [tsec, estep, elays, erows, ecols, spcs_list, emis_unc]
-        par_mutable = ['emis_unc']
+        par_name = ['tsec','nstep','nlays_emis','nrows','ncols','spcs','emis_unc','emis_mask']
+        par_val = [tsec, estep, elays, erows, ecols, spcs_list, emis_unc, emis_mask]
+        par_mutable = ['emis_unc','emis_mask']
         if inc_icon is True:
             par_name += [ 'nlays_icon', 'icon_unc' ]
             par_val += [ ilays, icon_unc ]
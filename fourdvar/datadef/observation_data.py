@@ -11,11 +11,14 @@ See the License for the specific language governing permissions and limitations
 import os
 import numpy as np
 from copy import deepcopy
+from scipy.sparse import csr_matrix
 
 from fourdvar.datadef.abstract._fourdvar_data import FourDVarData
 
 from fourdvar.util.archive_handle import get_archive_path
 import fourdvar.util.file_handle as fh
+import fourdvar.util.obs_handle as obs_handle
+import fourdvar.util.parallel_handle as parallel_handle
 import fourdvar.util.date_handle as dt
 import fourdvar.params.template_defn as template
 import fourdvar.util.netcdf_handle as ncf
@@ -26,21 +29,28 @@ logger = setup_logging.get_logger( __file__ )
 class ObservationData( FourDVarData ):
     """application: vector of observations, observed or simulated
     Can be either 'full' or 'lite' file.
-    'lite' file has no weight_grid attribute and cannot be used in transforms
-        (for achiving and analysis only)"""
+    'lite' file has no weight attributes and cannot be used in transforms
+        (for achiving and analysis only)
+    Weights are stored in CSR form, see obs_handle for details."""
     
     #Parameters
     length = None
     uncertainty = None
-    weight_grid = None
+    weight_ptr = None
+    weight_coord = None
+    weight_val = None
     offset_term = None
     misc_meta = None
     grid_attr = None
     ind_by_date = None
     spcs = None
     lite_coord = None
+    conc_shape = None
+    conc_slice = None
+    obs_matrix = None
     
-    archive_name = 'obsset.pickle.zip'
+    archive_name = 'obsset.nc'
+    iter_archive_name = 'obs_lite_iter.nc'
     
     def __init__( self, val_list, is_lite=False ):
         """
@@ -50,14 +60,14 @@ class ObservationData( FourDVarData ):
         
         eg: new_obs =  datadef.ObservationData( [{...}, {...}, ...] )
         
-        notes: Currently input is a list of floats.
+        notes: Currently input is a list (or array) of floats.
                Metadata created by from_file()
         """
         #params must all be set and not None
         self.is_lite = is_lite
         self.assert_params( need_weight=False )
-        assert len( val_list ) == self.length, 'invalid list of values'
-        self.value = [ float( v ) for v in val_list ]
+        self.value = np.array( val_list, dtype='float64' ).reshape( -1 )
+        assert self.value.size == self.length, 'invalid list of values'
         return None
     
     def get_vector( self ):
@@ -65,8 +75,10 @@ class ObservationData( FourDVarData ):
         framework: return the values of ObservationData as a 1D numpy array
         input: None
         output: np.ndarray
+        
+        notes: returns a view of the values, not a copy.
         """
-        return np.array( self.value )
+        return self.value.view()
         
     def archive( self, name=None, force_lite=False ):
         """
@@ -77,7 +89,9 @@ class ObservationData( FourDVarData ):
         notes: this will overwrite any clash in namespace.
         if input is None file will use default name.
         output file is in acceptable format for from_file method.
-        force_lite will archive obs-lite file (no weight_grid).
+        force_lite will archive obs-lite file (no weights).
+        names ending in obs_handle.ncf_ext are saved as netCDF,
+        other names are saved as a zipped pickle.
         """
         save_path = get_archive_path()
         if name is None:
@@ -92,21 +106,53 @@ class ObservationData( FourDVarData ):
         else:
             domain['is_lite'] = self.is_lite
         
+        if os.path.splitext( name )[1] in obs_handle.ncf_ext:
+            obs = { 'value': self.value, 'uncertainty': self.uncertainty,
+                    'offset_term': self.offset_term, 'lite_coord': self.lite_coord,
+                    'spcs': self.spcs, 'misc_meta': self.misc_meta }
+            if domain['is_lite'] is False:
+                obs['weight_ptr'] = self.weight_ptr
+                obs['weight_coord'] = self.weight_coord
+                obs['weight_val'] = self.weight_val
+            obs_handle.save_obs( save_path, domain, obs )
+            return None
+        
+        lite_coord = np.asarray( self.lite_coord )
         obs_list = []
-        for i in range( self.length ):
-            odict = deepcopy( self.misc_meta[i] )
+        for i, meta in enumerate( self.misc_meta ):
+            odict = deepcopy( meta )
             odict[ 'value' ] = self.value[i]
             odict[ 'uncertainty' ] = self.uncertainty[i]
             odict[ 'offset_term' ] = self.offset_term[i]
-            odict[ 'lite_coord' ] = self.lite_coord[i]
+            odict[ 'lite_coord' ] = obs_handle.coord_to_tuple( lite_coord[i], self.spcs )
             if domain['is_lite'] is False:
-                odict[ 'weight_grid' ] = self.weight_grid[i]
+                odict[ 'weight_grid' ] = self.get_weight_grid( i )
             obs_list.append( odict )
         
         archive_list = [ domain ] + obs_list
         fh.save_list( archive_list, save_path )
         return None
     
+    def archive_iter( self, iteration, name=None ):
+        """
+        extension: append values to an obs-lite archive of every iteration
+        input: int, string or None
+        output: None
+
+        notes: if input name is None file will use default name.
+        the obs-lite netCDF file is only written if it has no iterations of these
+        obs yet, so a restarted run keeps appending to the same file.
+        every call appends only the values (see obs_handle.append_obs_iter).
+        """
+        if name is None:
+            name = self.iter_archive_name
+        assert os.path.splitext( name )[1] in obs_handle.ncf_ext, 'iteration archive must be netCDF'
+        save_path = os.path.join( get_archive_path(), name )
+        if not obs_handle.has_obs_iter( save_path, self.length ):
+            self.archive( name, force_lite=True )
+        obs_handle.append_obs_iter( save_path, iteration, self.value )
+        return None
+    
     @classmethod
     def check_grid( cls, other_grid=template.conc ):
         """
@@ -126,8 +172,7 @@ class ObservationData( FourDVarData ):
         
         eg: weighted_residual = datadef.ObservationData.weight( residual )
         """
-        weighted = [ v/(u**2) for v,u in zip( res.value, res.uncertainty ) ]
-        return cls( weighted )
+        return cls( res.value / res.uncertainty**2 )
     
     @classmethod
     def get_residual( cls, observed, simulated ):
@@ -138,27 +183,29 @@ class ObservationData( FourDVarData ):
         
         eg: residual = datadef.ObservationData.get_residual( observed_obs, simulated_obs )
         """
-        res = [ s - o for o,s in zip( observed.value, simulated.value ) ]
-        return cls( res )
+        return cls( simulated.value - observed.value )
     
     @classmethod
-    def from_file( cls, filename ):
+    def from_file( cls, filename, lazy_meta=False ):
         """
         extension: create an ObservationData from a file
-        input: user-defined
+        input: string (path/to/file), bool
         output: ObservationData
         
-        eg: observed = datadef.ObservationData.from_file( "saved_obs.data" )
+        eg: observed = datadef.ObservationData.from_file( "saved_obs.nc" )
+        
+        notes: file can be netCDF or zipped pickle (see obs_handle).
+        lazy_meta=True only reads lite_coord & misc_meta from file when needed
+        (netCDF only), so they are not held in memory during the inversion,
+        but the file must then exist until the inversion is finished.
         """
-        datalist = fh.load_list( filename )
+        domain, obs = obs_handle.load_obs( filename, lazy_meta=lazy_meta )
+        #pool workers were forked with the old obs parameters
+        parallel_handle.close_pool()
         
-        domain = datalist[0]
         sdate = domain.pop('SDATE')
         edate = domain.pop('EDATE')
-        if 'is_lite' in domain.keys():
-            is_lite = domain.pop('is_lite')
-        else:
-            is_lite = False
+        is_lite = bool( domain.pop( 'is_lite', False ) )
         if cls.grid_attr is not None:
             logger.warn( 'Overwriting ObservationData.grid_attr' )
         cls.grid_attr = domain
@@ -167,65 +214,107 @@ class ObservationData( FourDVarData ):
         assert sdate == np.int32( dt.replace_date('<YYYYMMDD>',dt.start_date) ), msg
         assert edate == np.int32( dt.replace_date('<YYYYMMDD>',dt.end_date) ), msg
         
-        obs_list = datalist[1:]
-        unc = [ odict.pop('uncertainty') for odict in obs_list ]
-        val = [ odict.pop('value') for odict in obs_list ]
-        off = [ odict.pop('offset_term') for odict in obs_list ]
+        par_name = [ 'spcs', 'uncertainty', 'offset_term', 'lite_coord', 'misc_meta' ]
         if is_lite is False:
-            weight = [ odict.pop('weight_grid') for odict in obs_list ]
-        #create default 'lite_coord' if not available
-        coord = [ odict.pop('lite_coord',None) for odict in obs_list ]
-        if None in coord:
-            assert is_lite is False, 'Missing coordinate data.'
-            logger.warn( "Missing lite_coord data. Setting to coord with largest weight in weight_grid" )
-            for i,_ in enumerate( obs_list ):
-                if coord[i] is None:
-                    max_weight = max( [ (v,k,) for k,v in weight[i].items() ] )
-                    coord[i] = max_weight[1]
-        
+            par_name += [ 'weight_ptr', 'weight_coord', 'weight_val' ]
         if cls.length is not None:
             logger.warn( 'Overwriting ObservationData.length' )
-        cls.length = len( obs_list )
-        if cls.uncertainty is not None:
-            logger.warn( 'Overwriting ObservationData.uncertainty' )
-        cls.uncertainty = unc
-        if cls.offset_term is not None:
-            logger.warn( 'Overwriting ObservationData.offset_term' )
-        cls.offset_term = off
-        if cls.lite_coord is not None:
-            logger.warn( 'Overwriting ObservationData.lite_coord' )
-        cls.lite_coord = coord
-        if cls.misc_meta is not None:
-            logger.warn( 'Overwriting ObservationData.misc_meta' )
-        cls.misc_meta = obs_list
+        cls.length = obs['value'].size
+        for name in par_name:
+            if getattr( cls, name ) is not None:
+                logger.warn( 'Overwriting ObservationData.{}'.format( name ) )
+            setattr( cls, name, obs[ name ] )
+        
         if is_lite is False:
-            if cls.weight_grid is not None:
-                logger.warn( 'Overwriting ObservationData.weight_grid' )
-            cls.weight_grid = weight
+            cls.build_obs_matrix()
         
-        if is_lite is True:
-            all_spcs = set( str( coord[-1] ) for coord in cls.lite_coord )
-        else:
-            all_spcs = set()
-            for w in cls.weight_grid:
-                spcs = set( str( coord[-1] ) for coord in w.keys() )
-                all_spcs = all_spcs.union( spcs )
-        if cls.spcs is not None:
-            logger.warn( 'Overwriting ObservationData.spcs' )
-        cls.spcs = sorted( list( all_spcs ) )
+        return cls( obs['value'], is_lite=is_lite )
+    
+    @classmethod
+    def get_lite_coord( cls, i ):
+        """
+        extension: return the lite_coord of a single observation
+        input: int (index of observation)
+        output: tuple ( date, step, lay, row, col, spc )
+        """
+        return obs_handle.coord_to_tuple( cls.lite_coord[ i ], cls.spcs )
+    
+    @classmethod
+    def get_weight_grid( cls, i ):
+        """
+        extension: return the weight_grid of a single observation
+        input: int (index of observation)
+        output: dict { ( date, step, lay, row, col, spc ): weight }
+        """
+        start, end = cls.weight_ptr[ i ], cls.weight_ptr[ i+1 ]
+        return { obs_handle.coord_to_tuple( coord, cls.spcs ): float( weight )
+                 for coord, weight in zip( cls.weight_coord[ start:end ],
+                                           cls.weight_val[ start:end ] ) }
+    
+    @classmethod
+    def build_obs_matrix( cls ):
+        """
+        extension: compile the weights into a sparse matrix for each day
+        input: None
+        output: None
         
-        if is_lite is False:
-            dlist = [ dt.replace_date('<YYYYMMDD>',d) for d in dt.get_datelist() ]
-            ind_by_date = { d: [] for d in dlist }
-            for i, weight in enumerate( cls.weight_grid ):
-                dates = set( str( coord[0] ) for coord in weight.keys() )
-                for d in dates:
-                    ind_by_date[ d ].append( i )
-            if cls.ind_by_date is not None:
-                logger.warn( 'Overwriting ObservationData.ind_by_date' )
-            cls.ind_by_date = ind_by_date
+        notes: sets ind_by_date, conc_shape, conc_slice & obs_matrix.
+        conc_slice[ ymd ] is the ( step, lay, row, col ) hyperslab of that days
+        concentrations that holds every weight for that day.
+        obs_matrix[ ymd ] has a row for each obs in ind_by_date[ ymd ] and a
+        column for each element of the conc_slice[ ymd ] hyperslab, flattened
+        in ( step, lay, row, col, spc ) order.
+        """
+        nstep, nlay, nrow, ncol = ncf.get_variable( template.conc, cls.spcs[0] ).shape
+        conc_shape = ( nstep, nlay, nrow, ncol, len( cls.spcs ), )
+        
+        obs_ind = np.repeat( np.arange( cls.length ), np.diff( cls.weight_ptr ) )
+        coord_arr = cls.weight_coord
+        weight_arr = cls.weight_val
+        msg = 'weights have coordinates outside of the model grid'
+        assert ( coord_arr[:,1:] >= 0 ).all(), msg
+        assert ( coord_arr[:,1:5] < conc_shape[:4] ).all(), msg
+        assert ( coord_arr[:,5] < conc_shape[4] ).all(), msg
         
-        return cls( val, is_lite=is_lite )
+        ind_by_date = {}
+        conc_slice = {}
+        obs_matrix = {}
+        for date in dt.get_datelist():
+            ymd = dt.replace_date( '<YYYYMMDD>', date )
+            in_day = ( coord_arr[:,0] == int( ymd ) )
+            ilist = np.unique( obs_ind[ in_day ] )
+            day_coord = coord_arr[ in_day, 1: ]
+            if ilist.size > 0:
+                lower = day_coord[:,:4].min( axis=0 )
+                upper = day_coord[:,:4].max( axis=0 ) + 1
+            else:
+                lower = upper = np.zeros( 4, dtype=int )
+            box_shape = tuple( upper - lower ) + ( conc_shape[4], )
+            day_coord[:,:4] -= lower
+            flat_ind = np.ravel_multi_index( day_coord.T, box_shape )
+            mat_row = np.searchsorted( ilist, obs_ind[ in_day ] )
+            mat_shape = ( ilist.size, int( np.prod( box_shape ) ), )
+            ind_by_date[ ymd ] = ilist
+            conc_slice[ ymd ] = tuple( slice( l, u ) for l, u in zip( lower, upper ) )
+            obs_matrix[ ymd ] = csr_matrix( ( weight_arr[ in_day ],
+                                              ( mat_row, flat_ind, ) ),
+                                            shape=mat_shape )
+        msg = 'weights have coordinates outside of model dates'
+        assert sum( m.nnz for m in obs_matrix.values() ) == weight_arr.size, msg
+        
+        if cls.ind_by_date is not None:
+            logger.warn( 'Overwriting ObservationData.ind_by_date' )
+        cls.ind_by_date = ind_by_date
+        if cls.conc_shape is not None:
+            logger.warn( 'Overwriting ObservationData.conc_shape' )
+        cls.conc_shape = conc_shape
+        if cls.conc_slice is not None:
+            logger.warn( 'Overwriting ObservationData.conc_slice' )
+        cls.conc_slice = conc_slice
+        if cls.obs_matrix is not None:
+            logger.warn( 'Overwriting ObservationData.obs_matrix' )
+        cls.obs_matrix = obs_matrix
+        return None
     
     @classmethod
     def example( cls ):
@@ -244,7 +333,7 @@ class ObservationData( FourDVarData ):
     def assert_params( cls, need_weight=True ):
         """
         extension: assert that all needed observation parameters are valid
-        input: boolean (True == must have weight_grid (eg: not a obs-lite file))
+        input: boolean (True == must have weights (eg: not a obs-lite file))
         output: None
         """
         assert cls.length is not None, 'length is not set'
@@ -258,9 +347,16 @@ class ObservationData( FourDVarData ):
         assert len(cls.lite_coord) == cls.length, 'invalid lite_coord length'
         assert len(cls.misc_meta) == cls.length, 'invalid misc_meta length'
         if need_weight is True:
-            assert cls.weight_grid is not None, 'weight_grid is not set'
+            assert cls.weight_ptr is not None, 'weight_ptr is not set'
+            assert cls.weight_coord is not None, 'weight_coord is not set'
+            assert cls.weight_val is not None, 'weight_val is not set'
             assert cls.ind_by_date is not None, 'ind_by_date is not set'
-            assert len(cls.weight_grid)==cls.length, 'invalid weight_grid length'
+            assert cls.conc_shape is not None, 'conc_shape is not set'
+            assert cls.conc_slice is not None, 'conc_slice is not set'
+            assert cls.obs_matrix is not None, 'obs_matrix is not set'
+            assert len(cls.weight_ptr)==cls.length+1, 'invalid weight_ptr length'
+            assert len(cls.weight_coord)==cls.weight_ptr[-1], 'invalid weight_coord length'
+            assert len(cls.weight_val)==cls.weight_ptr[-1], 'invalid weight_val length'
         return None
     
     @classmethod
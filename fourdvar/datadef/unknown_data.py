@@ -11,21 +11,25 @@ See the License for the specific language governing permissions and limitations
 import numpy as np
 
 from fourdvar.datadef.abstract._fourdvar_data import FourDVarData
+from fourdvar.params.input_defn import value_dtype
 
 class UnknownData( FourDVarData ):
     """
     application: vector of unknowns/optimization values
     note: all methods except 'clone' are already framework
     """
-    def __init__( self, values ):
+    def __init__( self, values, copy=True ):
         """
         framework: create an instance of UnknownData
-        input: iterable of scalars (eg: list of floats)
+        input: iterable of scalars (eg: list of floats), bool
         output: None
         
         eg: new_unknown =  datadef.UnknownData( [ val1, val2, ... ] )
+        
+        notes: values are stored as input_defn.value_dtype,
+        if copy is False an array of that type is used without copying.
         """
-        self.value_arr = np.array( values, dtype='float64' )
+        self.value_arr = np.array( values, dtype=value_dtype, copy=copy )
         return None
     
     def get_vector( self ):
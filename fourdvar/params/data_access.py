@@ -13,3 +13,11 @@ allow_fwd_skip = False
 
 # previous unknown vector run through CMAQ_fwd
 prev_vector = None
+
+# No. of processes obs_operator & calc_forcing use to process days concurrently
+# workers are forked, so observation footprints are shared, not copied (1 = serial)
+obs_nproc = 1
+
+# shared pool of obs_nproc workers, created on first use (see util.parallel_handle)
+pool = None
+pool_nproc = None
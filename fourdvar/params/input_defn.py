@@ -16,7 +16,33 @@ from fourdvar.params.root_path_defn import store_path
 prior_file = os.path.join( store_path, 'input/prior.nc' )
 
 #full path to the obs file used by user_driver.get_observed
-obs_file = os.path.join( store_path, 'input/test_obs.pic.gz' )
+#netCDF obs format, older zipped pickle obs (eg: test_obs.pic.gz) still load by
+#extension but should be converted with obs_preprocess/convert_obs_pickle.py
+obs_file = os.path.join( store_path, 'input/test_obs.nc' )
+
+#only read obs lite_coord & misc_meta from obs_file when needed (netCDF only)
+#saves memory for large obs sets, but obs_file must stay in place for the whole run
+obs_lazy_meta = False
 
 #include model initial conditions in solution
 inc_icon = True
+
+#prior error correlation lengths, None = uncorrelated (diagonal prior error covariance)
+#correlation between 2 cells is exp( -distance / length ), for each dimension separately
+#horizontal in grid cells, vertical in layers, time in emis timesteps
+#not compatible with a prior MASK or emis uncertainty of 0
+#correlated unknowns can be negative, so user_driver.allow_neg_values must be True
+corr_length_horizontal = None
+corr_length_vertical = None
+corr_length_time = None
+
+#netCDF file with variable REGION (ROW, COL) giving the region No. of each cell
+#increments from the prior are shared by all cells of a region, None = one unknown per cell
+#aggregated unknowns can be negative, so user_driver.allow_neg_values must be True
+region_file = None
+#No. of emis timesteps that share an unknown, None = one unknown per timestep
+time_block = None
+
+#floating point type of the unknowns & physical data ('float64' or 'float32')
+#float32 halves their memory use, cost sums are still calculated in float64
+value_dtype = 'float64'
@@ -12,23 +12,41 @@ import numpy as np
 
 from fourdvar.datadef import ObservationData, AdjointForcingData, ModelOutputData
 import fourdvar.util.cmaq_handle as cmaq
+import fourdvar.util.parallel_handle as parallel_handle
+import fourdvar.params.data_access as data_access
+
+def force_day( arg ):
+    """
+    extension: calculate the adjoint forcing of a single day
+    input: tuple ( string (YYYYMMDD), np.ndarray (weighted residuals of that day) )
+    output: np.ndarray (forcing of ObservationData.conc_slice[ ymd ], spcs last)
+    """
+    ymd, w_day = arg
+    box = ObservationData.conc_slice[ ymd ]
+    box_shape = tuple( s.stop - s.start for s in box ) + ( len( ObservationData.spcs ), )
+    force = ObservationData.obs_matrix[ ymd ].T.dot( w_day )
+    return force.reshape( box_shape )
 
 def calc_forcing( w_residual ):
     """
     application: calculate the adjoint forcing values from the weighted residual of observations
     input: ObservationData  (weighted residuals)
     output: AdjointForcingData
+
+    notes: days are processed concurrently if data_access.obs_nproc > 1
     """
     
     kwargs = AdjointForcingData.get_kwargs_dict()
-    for ymd, ilist in ObservationData.ind_by_date.items():
+    w_val = w_residual.get_vector()
+    arg_list = [ ( ymd, w_val[ ilist ], )
+                 for ymd, ilist in ObservationData.ind_by_date.items()
+                 if len( ilist ) > 0 ]
+    force_list = parallel_handle.pool_map( force_day, arg_list, data_access.obs_nproc )
+    for ( ymd, _ ), force in zip( arg_list, force_list ):
         spc_dict = kwargs[ 'force.'+ymd ]
-        for i in ilist:
-            for coord,weight in ObservationData.weight_grid[i].items():
-                if str( coord[0] ) == ymd:
-                    step,lay,row,col,spc = coord[1:]
-                    w_val = w_residual.value[i] * weight
-                    spc_dict[spc][step,lay,row,col] += w_val
+        box = ObservationData.conc_slice[ ymd ]
+        for i, spc in enumerate( ObservationData.spcs ):
+            spc_dict[spc][ box ] += force[ ..., i ]
 
     cmaq.wipeout_bwd()
     
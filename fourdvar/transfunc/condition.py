@@ -12,7 +12,8 @@ import numpy as np
 
 from fourdvar.datadef import UnknownData
 from fourdvar.datadef.abstract._physical_abstract_data import PhysicalAbstractData
-from fourdvar.params.input_defn import inc_icon
+import fourdvar.util.corr_handle as corr_handle
+import fourdvar.util.aggregate_handle as aggregate_handle
 
 def condition_adjoint( physical_adjoint ):
     """
@@ -21,6 +22,8 @@ def condition_adjoint( physical_adjoint ):
     output: UnknownData
     
     notes: this function must apply the prior error covariance
+    (adjoint of uncondition: uncertainty, correlation square-root, then
+    sum over each region & time block)
     """
     return phys_to_unk( physical_adjoint, True )
 
@@ -31,6 +34,8 @@ def condition( physical ):
     output: UnknownData
     
     notes: this function must apply the inverse prior error covariance
+    (inverse of uncondition: uncertainty, inverse correlation square-root, then
+    mean over each region & time block of the increment from the prior)
     """
     return phys_to_unk( physical, False )
 
@@ -42,31 +47,29 @@ def phys_to_unk( physical, is_adjoint ):
     
     notes: this function must apply the inverse prior error covariance
     """
-    p = PhysicalAbstractData
-    emis_len = p.nstep * p.nlays_emis * p.nrows * p.ncols
-    if inc_icon is True:
-        icon_len = p.nlays_icon * p.nrows * p.ncols
-        total_len = len( p.spcs ) * ( icon_len + emis_len )
+    #physical values & uncertainty are stacked in UnknownData order
+    unc = PhysicalAbstractData.get_unc_buffer()
+    #inactive values (eg: no possible emissions) are fixed, they have no unknowns
+    active = PhysicalAbstractData.get_active()
+    if active is None:
+        arg = np.empty_like( unc )
+        where = True
     else:
-        total_len = len( p.spcs ) * emis_len
-    del p
-    
+        arg = np.zeros_like( unc )
+        where = active
     #weighting function changes if is_adjoint
     if is_adjoint is True:
-        weight = lambda val, sd: val * sd
+        np.multiply( physical.value_arr, unc, out=arg, where=where )
+    elif aggregate_handle.is_aggregated():
+        #aggregated unknowns are increments from the prior
+        prior = PhysicalAbstractData.get_prior_buffer()
+        np.divide( physical.value_arr - prior, unc, out=arg, where=where )
     else:
-        weight = lambda val, sd: val / sd
-    
-    arg = np.zeros( total_len )
-    i = 0
-    for spc in PhysicalAbstractData.spcs:
-        if inc_icon is True:
-            icon = weight( physical.icon[ spc ], physical.icon_unc[ spc ] )
-            arg[ i:i+icon_len ] = icon.flatten()
-            i += icon_len
-        emis = weight( physical.emis[ spc ], physical.emis_unc[ spc ] )
-        arg[ i:i+emis_len ] = emis.flatten()
-        i += emis_len
-    assert i == total_len, 'Some unknowns left unassigned!'
-    
-    return UnknownData( arg )
+        np.divide( physical.value_arr, unc, out=arg, where=where )
+    if corr_handle.is_correlated():
+        corr_handle.correlate( PhysicalAbstractData, arg, inverse=( is_adjoint is False ) )
+    if aggregate_handle.is_aggregated():
+        arg = aggregate_handle.reduce( PhysicalAbstractData, arg, mean=( is_adjoint is False ) )
+    elif active is not None:
+        arg = arg[ active ]
+    return UnknownData( arg, copy=False )
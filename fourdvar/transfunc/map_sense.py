@@ -97,13 +97,10 @@ def map_sense( sensitivity ):
     #emis_dict = { spcs: np.ndarray( nstep, nlays_emis, nrows, ncols ) }
     
     #create blank constructors for PhysicalAdjointData
-    p = PhysicalAdjointData
-    if inc_icon is True:
-        icon_shape = ( p.nlays_icon, p.nrows, p.ncols, )
-        icon_dict = { spc: np.zeros( icon_shape ) for spc in p.spcs }
-    emis_shape = ( p.nstep, p.nlays_emis, p.nrows, p.ncols, )
-    emis_dict = { spc: np.zeros( emis_shape ) for spc in p.spcs }
-    del p
+    #icon_dict & emis_dict are views into the result buffer, filled in-place
+    PhysicalAdjointData.assert_params()
+    phys_sense = PhysicalAdjointData.from_buffer( PhysicalAdjointData.zeros_buffer() )
+    icon_dict, emis_dict = phys_sense.icon, phys_sense.emis
     
     #construct icon_dict
     if inc_icon is True:
@@ -117,7 +114,7 @@ def map_sense( sensitivity ):
             assert ilays >= PhysicalAdjointData.nlays_icon, msg.format( 'nlays_icon' )
             assert irows == PhysicalAdjointData.nrows, msg.format( 'nrows' )
             assert icols == PhysicalAdjointData.ncols, msg.format( 'ncols' )
-            icon_dict[ spc ] = data[ 0:PhysicalAdjointData.nlays_icon, :, : ].copy()
+            icon_dict[ spc ][...] = data[ 0:PhysicalAdjointData.nlays_icon, :, : ]
     
     p_daysize = float(24*60*60) / PhysicalAdjointData.tsec
     emis_pattern = 'emis.<YYYYMMDD>'
@@ -154,8 +151,6 @@ def map_sense( sensitivity ):
             assert mcol == pcol, msg.format( 'ncols' )
             model_arr = model_arr[ :, :play, :, : ]
             phys_arr = model_arr.reshape((pstep,-1,play,prow,pcol)).sum(axis=1)
-            emis_dict[ spc ][ start:end, ... ] += phys_arr.copy()
+            emis_dict[ spc ][ start:end, ... ] += phys_arr
     
-    if inc_icon is False:
-        icon_dict = None
-    return PhysicalAdjointData( icon_dict, emis_dict )
+    return phys_sense
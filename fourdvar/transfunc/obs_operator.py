@@ -12,25 +12,39 @@ import numpy as np
 
 from fourdvar.datadef import ModelOutputData, ObservationData
 import fourdvar.util.netcdf_handle as ncf
+import fourdvar.util.parallel_handle as parallel_handle
+import fourdvar.params.data_access as data_access
+
+def sim_day( arg ):
+    """
+    extension: simulate the observations of a single day
+    input: tuple ( string (YYYYMMDD), string (path/to/conc_file) )
+    output: np.ndarray (simulated values of ObservationData.ind_by_date[ ymd ])
+    """
+    ymd, conc_file = arg
+    var_dict = ncf.get_variable( conc_file, ObservationData.spcs,
+                                 hyperslab=ObservationData.conc_slice[ ymd ] )
+    conc = np.stack( [ var_dict[spc] for spc in ObservationData.spcs ], axis=-1 )
+    return ObservationData.obs_matrix[ ymd ].dot( conc.ravel() )
 
 def obs_operator( model_output ):
     """
     application: simulate set of observations from output of the forward model
     input: ModelOutputData
     output: ObservationData
+
+    notes: days are processed concurrently if data_access.obs_nproc > 1
     """
     
     ObservationData.assert_params()
     
-    val_list = [ o for o in ObservationData.offset_term ]
-    for ymd, ilist in ObservationData.ind_by_date.items():
-        conc_file = model_output.file_data['conc.'+ymd]['actual']
-        var_dict = ncf.get_variable( conc_file, ObservationData.spcs )
-        for i in ilist:
-            for coord, weight in ObservationData.weight_grid[i].items():
-                if str( coord[0] ) == ymd:
-                    step,lay,row,col,spc = coord[1:]
-                    conc = var_dict[spc][step,lay,row,col]
-                    val_list[i] += (weight * conc)
+    arg_list = [ ( ymd, model_output.file_data['conc.'+ymd]['actual'], )
+                 for ymd, ilist in ObservationData.ind_by_date.items()
+                 if len( ilist ) > 0 ]
+    sim_list = parallel_handle.pool_map( sim_day, arg_list, data_access.obs_nproc )
+    
+    val_arr = ObservationData.offset_term.copy()
+    for ( ymd, _ ), sim in zip( arg_list, sim_list ):
+        val_arr[ ObservationData.ind_by_date[ ymd ] ] += sim
     
-    return ObservationData( val_list )
+    return ObservationData( val_arr )
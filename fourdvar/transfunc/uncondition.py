@@ -11,7 +11,8 @@ See the License for the specific language governing permissions and limitations
 import numpy as np
 
 from fourdvar.datadef import UnknownData, PhysicalData
-from fourdvar.params.input_defn import inc_icon
+import fourdvar.util.corr_handle as corr_handle
+import fourdvar.util.aggregate_handle as aggregate_handle
 
 def uncondition( unknown ):
     """
@@ -20,42 +21,37 @@ def uncondition( unknown ):
     output: PhysicalData
     
     notes: this function must apply the prior error covariance
+    (expand aggregated unknowns onto their regions & time blocks, square-root
+    of the correlation if correlation lengths are set, then uncertainty).
+    aggregated unknowns are increments added to the prior, so the prior keeps
+    its detail within each region & time block. inactive values are the prior.
     """
     PhysicalData.assert_params()
-    p = PhysicalData
-    emis_len = p.nstep * p.nlays_emis * p.nrows * p.ncols
-    if inc_icon is True:
-        icon_len = p.nlays_icon * p.nrows * p.ncols
-        total_len = len( p.spcs ) * ( icon_len + emis_len )
-    else:
-        total_len = len( p.spcs ) * emis_len
-    del p
-    
-    vals = unknown.get_vector()
-    if inc_icon is True:
-        icon_dict = {}
-    emis_dict = {}
-    i = 0
-    for spc in PhysicalData.spcs:
-        if inc_icon is True:
-            icon = vals[ i:i+icon_len ]
-            i += icon_len
-        emis = vals[ i:i+emis_len ]
-        i += emis_len
-        
-        p = PhysicalData
-        if inc_icon is True:
-            icon = icon.reshape(( p.nlays_icon, p.nrows, p.ncols, ))
-            icon = icon * p.icon_unc[ spc ]
-            icon_dict[ spc ] = icon
-        emis = emis.reshape(( p.nstep, p.nlays_emis, p.nrows, p.ncols, ))
-        emis = emis * p.emis_unc[ spc ]
-        emis_dict[ spc ] = emis
-        del p
+    unc = PhysicalData.get_unc_buffer()
+    vals = unknown.value_arr
+    #inactive values (eg: no possible emissions) have no unknowns, fixed at the prior
+    active = PhysicalData.get_active()
     
-    assert i == total_len, 'Some physical data left unassigned!'
+    #result buffer is in UnknownData order, icon & emis are views into it
+    if aggregate_handle.is_aggregated():
+        arg = aggregate_handle.expand( PhysicalData, vals )
+    elif active is not None:
+        assert vals.size == active.sum(), 'Some physical data left unassigned!'
+        arg = PhysicalData.zeros_buffer()
+        arg[ active ] = vals
+    else:
+        assert vals.size == unc.size, 'Some physical data left unassigned!'
+        arg = np.empty_like( unc )
+        if not corr_handle.is_correlated():
+            np.multiply( vals, unc, out=arg )
+            return PhysicalData.from_buffer( arg )
+        arg[...] = vals
     
-    if inc_icon is False:
-        icon_dict = None
-    return PhysicalData( icon_dict, emis_dict )
-
+    if corr_handle.is_correlated():
+        corr_handle.correlate( PhysicalData, arg )
+    np.multiply( arg, unc, out=arg )
+    if aggregate_handle.is_aggregated():
+        arg += PhysicalData.get_prior_buffer()
+    if active is not None:
+        arg[ ~active ] = PhysicalData.get_prior_buffer()[ ~active ]
+    return PhysicalData.from_buffer( arg )
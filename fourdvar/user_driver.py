@@ -17,7 +17,10 @@ from scipy.optimize import fmin_l_bfgs_b as minimize
 
 import fourdvar.datadef as d
 import fourdvar.util.archive_handle as archive
+import fourdvar.util.aggregate_handle as aggregate_handle
 import fourdvar.util.cmaq_handle as cmaq
+import fourdvar.util.corr_handle as corr_handle
+import fourdvar.util.parallel_handle as parallel_handle
 import fourdvar.params.input_defn as input_defn
 import fourdvar.params.data_access as data_access
 import fourdvar.params.archive_defn as archive_defn
@@ -30,6 +33,7 @@ observed = None
 background = None
 iter_num = 0
 
+#False = bound every unknown to >= 0 (only valid for unaggregated, uncorrelated unknowns)
 allow_neg_values = True
 
 def setup():
@@ -44,7 +48,7 @@ def setup():
     bg = get_background()
     obs = get_observed()
     bg.archive( 'prior.ncf' )
-    obs.archive( 'observed.pickle' )
+    obs.archive( 'observed.nc' )
     return None
 
 def cleanup():
@@ -54,6 +58,7 @@ def cleanup():
     output: None
     """
     cmaq.wipeout_fwd()
+    parallel_handle.close_pool()
     return None
 
 def get_background():
@@ -66,6 +71,8 @@ def get_background():
     
     if background is None:
         background = d.PhysicalData.from_file( input_defn.prior_file )
+    #condition & uncondition need the current prior (eg: aggregated increments)
+    d.PhysicalData.set_prior( background )
     return background
 
 def get_observed():
@@ -77,7 +84,10 @@ def get_observed():
     global observed
     
     if observed is None:
-        observed = d.ObservationData.from_file( input_defn.obs_file )
+        msg = 'missing {}, zipped pickle obs can be converted with convert_obs_pickle.py'
+        assert os.path.isfile( input_defn.obs_file ), msg.format( input_defn.obs_file )
+        observed = d.ObservationData.from_file( input_defn.obs_file,
+                                                lazy_meta=input_defn.obs_lazy_meta )
         observed.assert_params()
     return observed
 
@@ -98,8 +108,7 @@ def callback_func( current_vector ):
     if archive_defn.iter_obs_lite is True:
         current_model_output = d.ModelOutputData()
         current_obs = transform( current_model_output, d.ObservationData )
-        current_obs.archive( 'obs_lite_iter{:04}.pic.gz'.format( iter_num ),
-                             force_lite=True )
+        current_obs.archive_iter( iter_num )
     
     logger.info( 'iter_num = {}'.format( iter_num ) )
     
@@ -121,6 +130,12 @@ def minim( cost_func, grad_func, init_guess ):
     if allow_neg_values is True:
         bounds = None
     else:
+        #aggregated unknowns are increments from the prior, they can be negative
+        msg = 'allow_neg_values must be True when unknowns are aggregated (region_file/time_block)'
+        assert aggregate_handle.is_aggregated() is False, msg
+        #correlated unknowns mix many cells, bounding them doesn't bound the emissions
+        msg = 'allow_neg_values must be True when prior errors are correlated (corr_length_*)'
+        assert corr_handle.is_correlated() is False, msg
         bounds = len(init_guess) * [ (0,None) ]
     
     answer = minimize( cost_func, init_guess, bounds=bounds,
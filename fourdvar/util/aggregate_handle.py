@@ -0,0 +1,187 @@
+"""
+aggregate_handle.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import numpy as np
+
+import fourdvar.params.input_defn as input_defn
+import fourdvar.util.netcdf_handle as ncf
+
+#region of every horizontal cell, loaded from input_defn.region_file when first needed
+region_cache = {}
+#( active values, grid key, No. active values of every group ) last used by get_count
+count_cache = None
+
+def is_aggregated():
+    """
+    extension: True if the unknowns are aggregated into regions and/or time blocks
+    input: None
+    output: bool
+    """
+    return ( input_defn.region_file is not None or
+             input_defn.time_block is not None )
+
+def get_region( phys_class ):
+    """
+    extension: get the horizontal grouping of cells
+    input: PhysicalData class
+    output: dict { 'order': cell indices sorted by region,
+                   'start': index (in order) of the first cell of each region,
+                   'index': region No. of every cell, 'count': No. cells per region }
+
+    notes: without a region_file every cell is its own region.
+    region_file needs a variable REGION (ROW, COL) of int region No. 0 to nregion-1,
+    every cell must be in a region & every region must have a cell.
+    """
+    p = phys_class
+    ncell = p.nrows * p.ncols
+    key = ( input_defn.region_file, p.nrows, p.ncols, )
+    if key not in region_cache:
+        if input_defn.region_file is None:
+            index = np.arange( ncell )
+        else:
+            index = np.asarray( ncf.get_variable( input_defn.region_file, 'REGION' ) )
+            assert index.shape == ( p.nrows, p.ncols, ), 'REGION must match (ROW, COL).'
+            index = index.astype( 'int64' ).flatten()
+        count = np.bincount( index )
+        assert index.min() >= 0, 'every cell must be in a region.'
+        assert ( count > 0 ).all(), 'every region must have at least 1 cell.'
+        order = np.argsort( index, kind='mergesort' )
+        start = np.append( 0, np.cumsum( count )[:-1] )
+        region_cache[ key ] = { 'order': order, 'start': start,
+                                'index': index, 'count': count }
+    return region_cache[ key ]
+
+def get_time_start( phys_class ):
+    """
+    extension: index of the first emis timestep of every time block
+    input: PhysicalData class
+    output: np.ndarray
+    """
+    block = input_defn.time_block
+    if block is None:
+        block = 1
+    assert block >= 1, 'time_block must be a positive int.'
+    return np.arange( 0, phys_class.nstep, int( block ) )
+
+def get_shapes( phys_class ):
+    """
+    extension: shape of the aggregated icon & emis of one species
+    input: PhysicalData class
+    output: ( tuple or None, tuple )
+    """
+    p = phys_class
+    nregion = get_region( p )[ 'count' ].size
+    emis_shape = ( get_time_start( p ).size, p.nlays_emis, nregion, )
+    icon_shape = ( p.nlays_icon, nregion, ) if input_defn.inc_icon is True else None
+    return icon_shape, emis_shape
+
+def get_count( phys_class ):
+    """
+    extension: No. of active values in every region & time block
+    input: PhysicalData class
+    output: np.ndarray (1D float64, every group in sum_groups order)
+
+    notes: groups with no active values (eg: fully masked) have no unknown.
+    """
+    global count_cache
+    p = phys_class
+    active = p.get_active()
+    key = ( p.get_size(), input_defn.region_file, input_defn.time_block, )
+    if count_cache is None or count_cache[0] is not active or count_cache[1] != key:
+        if active is None:
+            count = sum_groups( p, np.ones( p.get_size() ) )
+        else:
+            count = sum_groups( p, active.astype( 'float64' ) )
+        count_cache = ( active, key, count, )
+    return count_cache[2]
+
+def get_size( phys_class ):
+    """
+    extension: No. of aggregated unknowns (groups with any active values)
+    input: PhysicalData class
+    output: int
+    """
+    return int( ( get_count( phys_class ) > 0 ).sum() )
+
+def expand( phys_class, value_arr ):
+    """
+    extension: copy aggregated unknowns onto every cell & timestep of their group
+    input: PhysicalData class, np.ndarray (1D, length get_size())
+    output: np.ndarray (1D physical buffer in UnknownData order)
+
+    notes: adjoint of this operator is reduce( ..., mean=False ).
+    groups with no active values are 0.
+    """
+    p = phys_class
+    assert value_arr.size == get_size( p ), 'aggregated unknowns have an invalid size.'
+    count = get_count( p )
+    all_groups = np.zeros( count.size, dtype=value_arr.dtype )
+    all_groups[ count > 0 ] = value_arr
+    region = get_region( p )[ 'index' ]
+    tstart = get_time_start( p )
+    tcount = np.diff( np.append( tstart, p.nstep ) )
+    icon_shape, emis_shape = get_shapes( p )
+    result = p.zeros_buffer()
+    icon_dict, emis_dict = p.get_views( result )
+    i = 0
+    for spc in p.spcs:
+        if icon_shape is not None:
+            size = int( np.prod( icon_shape ) )
+            icon = all_groups[ i:i+size ].reshape( icon_shape )
+            icon_dict[ spc ][...] = icon[ :, region ].reshape( icon_dict[ spc ].shape )
+            i += size
+        size = int( np.prod( emis_shape ) )
+        emis = all_groups[ i:i+size ].reshape( emis_shape )
+        emis = np.repeat( emis[ :, :, region ], tcount, axis=0 )
+        emis_dict[ spc ][...] = emis.reshape( emis_dict[ spc ].shape )
+        i += size
+    return result
+
+def sum_groups( phys_class, value_arr ):
+    """
+    extension: sum a physical buffer over each region & time block
+    input: PhysicalData class, np.ndarray (1D physical buffer in UnknownData order)
+    output: np.ndarray (1D float64, every group including those with no active values)
+    """
+    p = phys_class
+    region = get_region( p )
+    tstart = get_time_start( p )
+    icon_dict, emis_dict = p.get_views( value_arr )
+    ncell = p.nrows * p.ncols
+    result = []
+    for spc in p.spcs:
+        if input_defn.inc_icon is True:
+            icon = icon_dict[ spc ].reshape(( p.nlays_icon, ncell, ))
+            icon = np.add.reduceat( icon[ :, region[ 'order' ] ], region[ 'start' ],
+                                    axis=1, dtype='float64' )
+            result.append( icon.flatten() )
+        emis = emis_dict[ spc ].reshape(( p.nstep, p.nlays_emis, ncell, ))
+        emis = np.add.reduceat( emis[ :, :, region[ 'order' ] ], region[ 'start' ],
+                                axis=2, dtype='float64' )
+        emis = np.add.reduceat( emis, tstart, axis=0 )
+        result.append( emis.flatten() )
+    return np.concatenate( result )
+
+def reduce( phys_class, value_arr, mean=False ):
+    """
+    extension: sum (or average) a physical buffer over each region & time block
+    input: PhysicalData class, np.ndarray (1D physical buffer in UnknownData order), bool
+    output: np.ndarray (1D, length get_size())
+
+    notes: the sum is the adjoint of expand, the mean is its inverse
+    for a buffer that is constant over the active values of each group.
+    the mean is over active values only, inactive values must be 0.
+    sums are calculated in float64, the result has the dtype of value_arr.
+    """
+    count = get_count( phys_class )
+    result = sum_groups( phys_class, value_arr )[ count > 0 ]
+    if mean is True:
+        result /= count[ count > 0 ]
+    return result.astype( value_arr.dtype, copy=False )
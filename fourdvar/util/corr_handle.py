@@ -0,0 +1,101 @@
+"""
+corr_handle.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import numpy as np
+
+import fourdvar.params.input_defn as input_defn
+
+#cache of 1D correlation square-roots { (size, length, inverse): np.ndarray }
+matrix_cache = {}
+
+def is_correlated():
+    """
+    extension: True if any prior error correlation length is defined
+    input: None
+    output: bool
+    """
+    length_list = [ input_defn.corr_length_horizontal,
+                    input_defn.corr_length_vertical,
+                    input_defn.corr_length_time ]
+    return any( l is not None for l in length_list )
+
+def get_corr_sqrt( size, length, inverse=False ):
+    """
+    extension: symmetric square-root of a 1D correlation matrix
+    input: int (No. points), float or None (length in points), bool
+    output: np.ndarray (size, size) or None (uncorrelated)
+
+    notes: correlation between points i & j is exp( -|i-j| / length ),
+    this matrix is positive definite for every length > 0.
+    if inverse is True the inverse of the square-root is returned.
+    """
+    if length is None or size < 2:
+        return None
+    assert length > 0, 'correlation length must be positive.'
+    key = ( size, float( length ), inverse, )
+    if key not in matrix_cache:
+        pos = np.arange( size, dtype='float64' )
+        corr = np.exp( -np.abs( pos[:,None] - pos[None,:] ) / float( length ) )
+        eig_val, eig_vec = np.linalg.eigh( corr )
+        assert eig_val.min() > 0, 'correlation length too long for {} points.'.format( size )
+        scale = eig_val**-0.5 if inverse is True else eig_val**0.5
+        matrix_cache[ key ] = np.dot( eig_vec * scale, eig_vec.T )
+    return matrix_cache[ key ]
+
+def apply_1d( arr, matrix, axis ):
+    """
+    extension: multiply every 1D slice of an array along axis by matrix
+    input: np.ndarray, np.ndarray (square) or None, int
+    output: np.ndarray (same shape as arr, float64)
+
+    notes: always calculated in float64, the inverse square-root can be badly
+    conditioned for long correlation lengths.
+    """
+    if matrix is None:
+        return arr
+    result = np.tensordot( matrix, arr.astype( 'float64', copy=False ), axes=( [1], [axis] ) )
+    return np.moveaxis( result, 0, axis )
+
+def correlate( phys_class, value_arr, inverse=False ):
+    """
+    extension: apply the prior error correlation square-root to a physical buffer
+    input: PhysicalData class, np.ndarray (1D buffer in UnknownData order), bool
+    output: None (value_arr is updated in place)
+
+    notes: correlation is separable (Kronecker product of 1D correlations):
+    horizontal (rows & columns), vertical (layers) & time (emis steps only).
+    matrices are symmetric so the same operator is its own adjoint.
+    if inverse is True the inverse square-root is applied.
+    every value must be active (no MASK or 0 uncertainty), the correlation
+    of the remaining values would not be separable.
+    """
+    horiz = input_defn.corr_length_horizontal
+    vert = input_defn.corr_length_vertical
+    p = phys_class
+    msg = 'correlation lengths cannot be used with inactive values (MASK or 0 uncertainty).'
+    assert p.get_active() is None, msg
+    row_mat = get_corr_sqrt( p.nrows, horiz, inverse )
+    col_mat = get_corr_sqrt( p.ncols, horiz, inverse )
+    emis_mat = [ get_corr_sqrt( p.nstep, input_defn.corr_length_time, inverse ),
+                 get_corr_sqrt( p.nlays_emis, vert, inverse ), row_mat, col_mat ]
+    if input_defn.inc_icon is True:
+        icon_mat = [ get_corr_sqrt( p.nlays_icon, vert, inverse ), row_mat, col_mat ]
+    icon_dict, emis_dict = p.get_views( value_arr )
+    for spc in p.spcs:
+        if input_defn.inc_icon is True:
+            icon = icon_dict[ spc ]
+            for axis, matrix in enumerate( icon_mat ):
+                icon = apply_1d( icon, matrix, axis )
+            icon_dict[ spc ][...] = icon
+        emis = emis_dict[ spc ]
+        for axis, matrix in enumerate( emis_mat ):
+            emis = apply_1d( emis, matrix, axis )
+        emis_dict[ spc ][...] = emis
+    return None
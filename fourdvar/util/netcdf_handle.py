@@ -72,24 +72,28 @@ def create_from_template( source, dest, var_change={}, date=None, overwrite=True
             set_date( ncf_file, date )
     return None
 
-def get_variable( filepath, varname, group=None ):
+def get_variable( filepath, varname, group=None, hyperslab=None ):
     """
     extension: get all the values of a single variable
-    input: string (path/to/file.ncf), string <OR> list, string (optional)
+    input: string (path/to/file.ncf), string <OR> list, string (optional), tuple (optional)
     output: numpy.ndarray OR dict
     
     notes: group allows chosing netCDF4 groups, leave as None to use root
     if varname is a string an array is returned, otherwise a dict is.
+    hyperslab is a tuple of slices (1 per dimension), only this part of
+    each variable is read. leave as None to read all values.
     """
     with ncf.Dataset( filepath, 'r' ) as ncf_file:
         source = ncf_file
         if group is not None:
             for g in group.split( '/' ):
                 source = source.groups[ g ]
+        if hyperslab is None:
+            hyperslab = slice( None )
         if str(varname) == varname:
-            result = source.variables[ varname ][:]
+            result = source.variables[ varname ][ hyperslab ]
         else:
-            result = { k:v[:] for k,v in source.variables.items() if k in varname }
+            result = { k:v[ hyperslab ] for k,v in source.variables.items() if k in varname }
     return result
 
 def get_attr( filepath, attrname, group=None ):
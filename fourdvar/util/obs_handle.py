@@ -0,0 +1,490 @@
+"""
+obs_handle.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os
+import numpy as np
+import cPickle as pickle
+from netCDF4 import Dataset
+
+import fourdvar.util.file_handle as fh
+import fourdvar.util.netcdf_handle as ncf
+
+import setup_logging
+logger = setup_logging.get_logger( __file__ )
+
+#observation files with these extensions are written as netCDF,
+#everything else is written as a zipped pickle (see file_handle.save_list)
+ncf_ext = [ '.nc', '.ncf', '.nc4' ]
+
+#keys of an obs dict that are stored as columns, the rest is misc_meta
+obs_keys = [ 'value', 'uncertainty', 'offset_term', 'lite_coord', 'weight_grid' ]
+
+#obs columns:
+#  value, uncertainty, offset_term = np.ndarray( nobs, float64 )
+#  lite_coord = np.ndarray( (nobs,6), int ) [date,step,lay,row,col,spc_index]
+#  spcs = list of species names (spc_index refers to this list)
+#  misc_meta = list-like of dicts (every other key of an obs dict)
+#  weight_ptr = np.ndarray( nobs+1, int ) (not in lite files)
+#  weight_coord = np.ndarray( (nweight,6), int ) (not in lite files)
+#  weight_val = np.ndarray( nweight, float64 ) (not in lite files)
+#weights of obs i are weight_coord/val[ weight_ptr[i]:weight_ptr[i+1] ]
+#lite_coord & misc_meta can also be file-backed (ArrayColumn & MetaColumn)
+#netCDF files can also store values of many iterations, see append_obs_iter
+
+def is_ncf( filepath ):
+    """
+    extension: test if an existing file is netCDF (as opposed to a zipped pickle)
+    input: string (path/to/file)
+    output: bool
+    """
+    with open( filepath, 'rb' ) as f:
+        magic = f.read( 4 )
+    return magic[:3] == 'CDF' or magic == '\x89HDF'
+
+def coord_to_tuple( coord, spcs ):
+    """
+    extension: convert an int coordinate array into a coordinate tuple
+    input: np.ndarray( 6 ), list of spcs names
+    output: tuple ( date, step, lay, row, col, spc )
+    """
+    return tuple( int( c ) for c in coord[:-1] ) + ( spcs[ coord[-1] ], )
+
+def obslist_to_columns( obs_list, is_lite=False ):
+    """
+    extension: convert a list of obs dicts into obs columns
+    input: list of dicts (format from obs_preprocess), bool
+    output: dict (obs columns, see module notes)
+
+    notes: obs missing a lite_coord use the weight_grid coord with the largest weight.
+    """
+    nobs = len( obs_list )
+    value = np.array( [ o['value'] for o in obs_list ], dtype='float64' )
+    unc = np.array( [ o['uncertainty'] for o in obs_list ], dtype='float64' )
+    off = np.array( [ o['offset_term'] for o in obs_list ], dtype='float64' )
+    meta = [ { k:v for k,v in o.items() if k not in obs_keys } for o in obs_list ]
+
+    #create default 'lite_coord' if not available
+    coord = [ o.get( 'lite_coord', None ) for o in obs_list ]
+    if None in coord:
+        assert is_lite is False, 'Missing coordinate data.'
+        logger.warn( "Missing lite_coord data. Setting to coord with largest weight in weight_grid" )
+        for i,odict in enumerate( obs_list ):
+            if coord[i] is None:
+                max_weight = max( [ (v,k,) for k,v in odict['weight_grid'].items() ] )
+                coord[i] = max_weight[1]
+
+    if is_lite is True:
+        all_spcs = set( str( c[-1] ) for c in coord )
+    else:
+        all_spcs = set()
+        for odict in obs_list:
+            all_spcs.update( str( c[-1] ) for c in odict['weight_grid'].keys() )
+    spcs = sorted( list( all_spcs ) )
+    spc_ind = { spc: i for i, spc in enumerate( spcs ) }
+
+    #coordinates stored as int arrays, spc replaced with its index in spcs
+    to_int = lambda c: tuple( int(v) for v in c[:-1] ) + ( spc_ind[ str(c[-1]) ], )
+    assert all( str( c[-1] ) in spc_ind for c in coord ), 'invalid lite_coord spcs'
+    lite_coord = np.array( [ to_int( c ) for c in coord ], dtype=int ).reshape(( nobs, 6, ))
+
+    obs = { 'value': value, 'uncertainty': unc, 'offset_term': off,
+            'lite_coord': lite_coord, 'spcs': spcs, 'misc_meta': meta }
+    if is_lite is False:
+        nweight = [ len( o['weight_grid'] ) for o in obs_list ]
+        #weights are sorted by coord so the layout doesn't depend on dict order
+        w_items = [ sorted( o['weight_grid'].items() ) for o in obs_list ]
+        w_coord = [ to_int( c ) for items in w_items for c,_ in items ]
+        w_val = [ v for items in w_items for _,v in items ]
+        obs['weight_ptr'] = np.append( 0, np.cumsum( nweight ) ).astype( 'int64' )
+        obs['weight_coord'] = np.array( w_coord, dtype=int ).reshape(( -1, 6, ))
+        obs['weight_val'] = np.array( w_val, dtype='float64' )
+    return obs
+
+def columns_to_obslist( obs, start=0, end=None ):
+    """
+    extension: convert obs columns back into a list of obs dicts
+    input: dict (obs columns, misc_meta as a list), int, int or None
+    output: list of dicts (format from obs_preprocess)
+
+    notes: only obs [start:end] are converted (None = until the last obs).
+    """
+    nobs = len( obs['value'] )
+    end = nobs if end is None else min( end, nobs )
+    lite_coord = np.asarray( obs['lite_coord'][ start:end ] )
+    obs_list = []
+    for i in range( start, end ):
+        odict = dict( obs['misc_meta'][i] )
+        odict[ 'value' ] = float( obs['value'][i] )
+        odict[ 'uncertainty' ] = float( obs['uncertainty'][i] )
+        odict[ 'offset_term' ] = float( obs['offset_term'][i] )
+        odict[ 'lite_coord' ] = coord_to_tuple( lite_coord[ i-start ], obs['spcs'] )
+        if 'weight_ptr' in obs:
+            w0, w1 = obs['weight_ptr'][i], obs['weight_ptr'][i+1]
+            odict[ 'weight_grid' ] = { coord_to_tuple( c, obs['spcs'] ): float( v ) for c, v in
+                                       zip( obs['weight_coord'][w0:w1], obs['weight_val'][w0:w1] ) }
+        obs_list.append( odict )
+    return obs_list
+
+class ArrayColumn( object ):
+    """read-only, array-like access to a variable of an obs netCDF file.
+    Values are only read from the file when they are requested."""
+
+    def __init__( self, filepath, varname ):
+        self.filepath = os.path.realpath( filepath )
+        self.varname = varname
+        with Dataset( self.filepath, 'r' ) as f:
+            var = f.variables[ varname ]
+            self.shape = var.shape
+            self.dtype = var.dtype
+        return None
+
+    def __len__( self ):
+        return self.shape[0]
+
+    def __getitem__( self, key ):
+        with Dataset( self.filepath, 'r' ) as f:
+            f.set_auto_mask( False )
+            result = f.variables[ self.varname ][ key ]
+        return result
+
+    def __array__( self, dtype=None ):
+        result = self[:]
+        if dtype is not None:
+            result = result.astype( dtype )
+        return result
+
+class MetaColumn( object ):
+    """read-only, list-like access to the misc_meta of an obs netCDF file.
+    Each obs dict is unpickled from the file when it is requested."""
+
+    #No. of obs read from file at a time when iterating
+    chunk_size = 10000
+
+    def __init__( self, filepath ):
+        self.filepath = os.path.realpath( filepath )
+        with Dataset( self.filepath, 'r' ) as f:
+            f.set_auto_mask( False )
+            self.ptr = f.variables[ 'meta_ptr' ][:]
+        return None
+
+    def __len__( self ):
+        return self.ptr.size - 1
+
+    def __getitem__( self, i ):
+        start, end = self.ptr[ i ], self.ptr[ i+1 ]
+        with Dataset( self.filepath, 'r' ) as f:
+            f.set_auto_mask( False )
+            raw = f.variables[ 'meta_data' ][ start:end ]
+        return pickle.loads( raw.tostring() )
+
+    def __iter__( self ):
+        for first in range( 0, len( self ), self.chunk_size ):
+            for meta in self.get_range( first, first+self.chunk_size ):
+                yield meta
+
+    def get_range( self, first, last ):
+        """return the obs dicts [first:last] as a list, read from file at once"""
+        ptr = self.ptr[ first:last+1 ]
+        if ptr.size < 2:
+            return []
+        with Dataset( self.filepath, 'r' ) as f:
+            f.set_auto_mask( False )
+            raw = f.variables[ 'meta_data' ][ ptr[0]:ptr[-1] ].tostring()
+        ptr = ptr - ptr[0]
+        return [ pickle.loads( raw[ start:end ] ) for start, end in zip( ptr[:-1], ptr[1:] ) ]
+
+    def get_raw( self ):
+        """return (ptr, bytes) of every pickled obs dict, without unpickling"""
+        with Dataset( self.filepath, 'r' ) as f:
+            f.set_auto_mask( False )
+            raw = f.variables[ 'meta_data' ][:]
+        return self.ptr, raw
+
+def save_obs( filepath, domain, obs ):
+    """
+    extension: save observations to a netCDF file
+    input: string (path/to/file.nc), dict (domain), dict (obs columns)
+    output: None
+
+    notes: domain is the grid attributes plus SDATE, EDATE & is_lite.
+    weights are only written if domain['is_lite'] is False.
+    file-backed columns are copied without unpickling the metadata.
+    """
+    fpath = os.path.realpath( filepath )
+    fh.ensure_path( os.path.dirname( fpath ) )
+
+    lite_coord = obs['lite_coord']
+    if isinstance( lite_coord, ArrayColumn ):
+        lite_coord = lite_coord[:]
+
+    attr = { k:v for k,v in domain.items() if k != 'is_lite' }
+    is_lite = bool( domain.get( 'is_lite', False ) )
+    attr[ 'is_lite' ] = np.int8( is_lite )
+    attr[ 'OBS-SPCS' ] = ''.join( [ '{:<16}'.format( s ) for s in obs['spcs'] ] )
+
+    if isinstance( obs['misc_meta'], MetaColumn ):
+        meta_ptr, meta_data = obs['misc_meta'].get_raw()
+    else:
+        meta_list = [ pickle.dumps( m, pickle.HIGHEST_PROTOCOL ) for m in obs['misc_meta'] ]
+        meta_ptr = np.append( 0, np.cumsum( [ len( m ) for m in meta_list ] ) )
+        meta_data = np.frombuffer( ''.join( meta_list ), dtype=np.uint8 )
+
+    nobs = obs['value'].size
+    dim = { 'OBS': nobs, 'PTR': nobs+1, 'COORD': 6, 'META': meta_data.size }
+    var = { 'value': ( 'f8', ('OBS',), obs['value'] ),
+            'uncertainty': ( 'f8', ('OBS',), obs['uncertainty'] ),
+            'offset_term': ( 'f8', ('OBS',), obs['offset_term'] ),
+            'lite_coord': ( 'i4', ('OBS','COORD',), lite_coord ),
+            'meta_ptr': ( 'i8', ('PTR',), meta_ptr ),
+            'meta_data': ( 'u1', ('META',), meta_data ) }
+    if is_lite is False:
+        dim[ 'WEIGHT' ] = obs['weight_val'].size
+        var[ 'weight_ptr' ] = ( 'i8', ('PTR',), obs['weight_ptr'] )
+        var[ 'weight_coord' ] = ( 'i4', ('WEIGHT','COORD',), obs['weight_coord'] )
+        var[ 'weight_val' ] = ( 'f8', ('WEIGHT',), obs['weight_val'] )
+
+    root = ncf.create( path=fpath, attr=attr, dim=dim, var=var, is_root=True )
+    root.close()
+    return None
+
+def has_obs_iter( filepath, nobs ):
+    """
+    extension: True if filepath is an obs netCDF file holding iterations of nobs values
+    input: string (path/to/file.nc), int
+    output: bool
+    """
+    if not os.path.isfile( filepath ) or not is_ncf( filepath ):
+        return False
+    with Dataset( filepath, 'r' ) as f:
+        return ( 'ITER' in f.dimensions and 'OBS' in f.dimensions and
+                 len( f.dimensions['OBS'] ) == nobs )
+
+def append_obs_iter( filepath, iteration, value ):
+    """
+    extension: append the obs values of one iteration to an obs netCDF file
+    input: string (path/to/file.nc), int, np.ndarray( nobs )
+    output: None
+
+    notes: values are stored in iter_value[ ITER, OBS ], ITER is unlimited.
+    if iteration is already in the file its values are overwritten.
+    """
+    with Dataset( filepath, 'a' ) as f:
+        if 'ITER' not in f.dimensions:
+            f.createDimension( 'ITER', None )
+            f.createVariable( 'iter_num', 'i4', ('ITER',) )
+            f.createVariable( 'iter_value', 'f8', ('ITER','OBS',),
+                              chunksizes=( 1, len( f.dimensions['OBS'] ), ) )
+        f.set_auto_mask( False )
+        iter_list = list( f.variables[ 'iter_num' ][:] )
+        if iteration in iter_list:
+            ind = iter_list.index( iteration )
+        else:
+            ind = len( iter_list )
+        f.variables[ 'iter_num' ][ ind ] = iteration
+        f.variables[ 'iter_value' ][ ind, : ] = value
+    return None
+
+def load_obs_iter( filepath ):
+    """
+    extension: load every iteration of obs values from an obs netCDF file
+    input: string (path/to/file.nc)
+    output: np.ndarray( niter ), np.ndarray( niter, nobs )
+    """
+    with Dataset( filepath, 'r' ) as f:
+        f.set_auto_mask( False )
+        iter_num = f.variables[ 'iter_num' ][:]
+        iter_value = f.variables[ 'iter_value' ][:]
+    return iter_num, iter_value
+
+def load_obs( filepath, lazy_meta=False ):
+    """
+    extension: load observations from a netCDF or zipped pickle file
+    input: string (path/to/file), bool
+    output: dict (domain), dict (obs columns)
+
+    notes: if lazy_meta is True (netCDF only) lite_coord is an ArrayColumn
+    and misc_meta is a MetaColumn, both are only read from file when needed.
+    zipped pickle files are always read completely into memory.
+    """
+    if is_ncf( filepath ) is False:
+        if lazy_meta is True:
+            logger.warn( 'cannot lazy load metadata from {}, convert it to netCDF.'.format( filepath ) )
+        datalist = fh.load_list( filepath )
+        domain = datalist[0]
+        is_lite = domain.get( 'is_lite', False )
+        return domain, obslist_to_columns( datalist[1:], is_lite=is_lite )
+
+    with Dataset( filepath, 'r' ) as f:
+        f.set_auto_mask( False )
+        domain = { k: f.getncattr( k ) for k in f.ncattrs() }
+        domain[ 'is_lite' ] = bool( domain[ 'is_lite' ] )
+        obs = { 'spcs': str( domain.pop( 'OBS-SPCS' ) ).split() }
+        col_list = [ 'value', 'uncertainty', 'offset_term' ]
+        if domain[ 'is_lite' ] is False:
+            col_list += [ 'weight_ptr', 'weight_coord', 'weight_val' ]
+        for col in col_list:
+            obs[ col ] = f.variables[ col ][:]
+    if 'weight_coord' in obs:
+        obs[ 'weight_coord' ] = obs[ 'weight_coord' ].astype( int )
+    obs[ 'lite_coord' ] = ArrayColumn( filepath, 'lite_coord' )
+    obs[ 'misc_meta' ] = MetaColumn( filepath )
+    if lazy_meta is False:
+        obs[ 'lite_coord' ] = obs[ 'lite_coord' ][:].astype( int )
+        obs[ 'misc_meta' ] = list( obs[ 'misc_meta' ] )
+    return domain, obs
+
+def load_columns( filepath, start=0, end=None ):
+    """
+    extension: load the obs columns of obs [start:end] from a netCDF obs file
+    input: string (path/to/file), int, int or None
+    output: dict (obs columns, misc_meta as a list)
+
+    notes: only obs [start:end] are read from file (None = until the last obs),
+    so a large file can be processed in chunks. weight_ptr starts at 0.
+    """
+    with Dataset( filepath, 'r' ) as f:
+        f.set_auto_mask( False )
+        is_lite = bool( f.getncattr( 'is_lite' ) )
+        obs = { 'spcs': str( f.getncattr( 'OBS-SPCS' ) ).split() }
+        nobs = len( f.dimensions[ 'OBS' ] )
+        end = nobs if end is None else min( end, nobs )
+        start = min( start, end )
+        for col in [ 'value', 'uncertainty', 'offset_term' ]:
+            obs[ col ] = f.variables[ col ][ start:end ]
+        obs[ 'lite_coord' ] = f.variables[ 'lite_coord' ][ start:end ].astype( int )
+        if is_lite is False:
+            ptr = f.variables[ 'weight_ptr' ][ start:end+1 ]
+            obs[ 'weight_coord' ] = f.variables[ 'weight_coord' ][ ptr[0]:ptr[-1] ].astype( int )
+            obs[ 'weight_val' ] = f.variables[ 'weight_val' ][ ptr[0]:ptr[-1] ]
+            obs[ 'weight_ptr' ] = ptr - ptr[0]
+    obs[ 'misc_meta' ] = MetaColumn( filepath ).get_range( start, end )
+    return obs
+
+def save_list( obs_list, filepath ):
+    """
+    extension: save a list of obs (domain first, as made by obs_preprocess)
+    input: list, string (path/to/file)
+    output: None
+
+    notes: output format is chosen by file extension (see ncf_ext),
+    netCDF for '.nc' files, zipped pickle otherwise.
+    """
+    if os.path.splitext( filepath )[1] not in ncf_ext:
+        fh.save_list( obs_list, filepath )
+        return None
+    domain = obs_list[0]
+    is_lite = domain.get( 'is_lite', False )
+    save_obs( filepath, domain, obslist_to_columns( obs_list[1:], is_lite=is_lite ) )
+    return None
+
+class ObsWriter( object ):
+    """write observations to file incrementally, one list of obs dicts at a time.
+    netCDF files use unlimited dimensions and are appended to as they arrive,
+    zipped pickle files can't be appended so obs are kept until close.
+    output file is only complete (readable by load_obs) after close."""
+
+    #netCDF chunk length of every variable (along the unlimited dimension)
+    chunk_len = 2**16
+
+    def __init__( self, filepath, domain ):
+        self.filepath = os.path.realpath( filepath )
+        self.domain = domain
+        self.is_lite = bool( domain.get( 'is_lite', False ) )
+        self.spcs = []
+        self.count = 0
+        self.is_ncf = ( os.path.splitext( filepath )[1] in ncf_ext )
+        if self.is_ncf is False:
+            self.obs_list = []
+            return None
+        
+        fh.ensure_path( os.path.dirname( self.filepath ) )
+        attr = { k:v for k,v in domain.items() if k != 'is_lite' }
+        attr[ 'is_lite' ] = np.int8( self.is_lite )
+        dim = { 'OBS': None, 'PTR': None, 'COORD': 6, 'META': None }
+        #{ name: ( dtype, dims ) }, variables are chunked to make appending fast
+        var = { 'value': ( 'f8', ('OBS',) ),
+                'uncertainty': ( 'f8', ('OBS',) ),
+                'offset_term': ( 'f8', ('OBS',) ),
+                'lite_coord': ( 'i4', ('OBS','COORD',) ),
+                'meta_ptr': ( 'i8', ('PTR',) ),
+                'meta_data': ( 'u1', ('META',) ) }
+        if self.is_lite is False:
+            dim[ 'WEIGHT' ] = None
+            var[ 'weight_ptr' ] = ( 'i8', ('PTR',) )
+            var[ 'weight_coord' ] = ( 'i4', ('WEIGHT','COORD',) )
+            var[ 'weight_val' ] = ( 'f8', ('WEIGHT',) )
+        self.root = ncf.create( path=self.filepath, attr=attr, dim=dim, is_root=True )
+        for name, ( dtype, vdim ) in var.items():
+            chunk = [ self.chunk_len ] + [ 6 ] * ( len( vdim ) - 1 )
+            self.root.createVariable( name, dtype, vdim, chunksizes=chunk )
+        self.root.variables[ 'meta_ptr' ][ 0 ] = 0
+        if self.is_lite is False:
+            self.root.variables[ 'weight_ptr' ][ 0 ] = 0
+        return None
+
+    def append( self, obs_list ):
+        """add a list of obs dicts (format from obs_preprocess) to the output file"""
+        if self.is_ncf is False:
+            self.count += len( obs_list )
+            self.obs_list.extend( obs_list )
+            return None
+        if len( obs_list ) == 0:
+            return None
+        self.append_columns( obslist_to_columns( obs_list, is_lite=self.is_lite ) )
+        return None
+
+    def append_columns( self, obs ):
+        """add obs columns (see module notes) to the output file"""
+        nobs = len( obs['value'] )
+        if self.is_ncf is False:
+            self.append( columns_to_obslist( obs ) )
+            return None
+        if nobs == 0:
+            return None
+        self.count += nobs
+        #map spc index of this chunk onto the spcs of the whole file
+        for spc in obs['spcs']:
+            if spc not in self.spcs:
+                self.spcs.append( spc )
+        spc_map = np.array( [ self.spcs.index( spc ) for spc in obs['spcs'] ], dtype=int )
+        
+        meta_list = [ pickle.dumps( m, pickle.HIGHEST_PROTOCOL ) for m in obs['misc_meta'] ]
+        meta_len = np.array( [ len( m ) for m in meta_list ], dtype='int64' )
+        var = self.root.variables
+        o0 = len( self.root.dimensions['OBS'] )
+        o1 = o0 + nobs
+        m0 = len( self.root.dimensions['META'] )
+        lite_coord = np.array( obs['lite_coord'] )
+        lite_coord[:,-1] = spc_map[ lite_coord[:,-1] ]
+        var['value'][ o0:o1 ] = obs['value']
+        var['uncertainty'][ o0:o1 ] = obs['uncertainty']
+        var['offset_term'][ o0:o1 ] = obs['offset_term']
+        var['lite_coord'][ o0:o1, : ] = lite_coord
+        var['meta_ptr'][ o0+1:o1+1 ] = m0 + np.cumsum( meta_len )
+        var['meta_data'][ m0:m0+meta_len.sum() ] = np.frombuffer( ''.join( meta_list ), dtype=np.uint8 )
+        if self.is_lite is False:
+            w0 = len( self.root.dimensions['WEIGHT'] )
+            w1 = w0 + obs['weight_val'].size
+            weight_coord = np.array( obs['weight_coord'] )
+            weight_coord[:,-1] = spc_map[ weight_coord[:,-1] ]
+            var['weight_ptr'][ o0+1:o1+1 ] = w0 + obs['weight_ptr'][1:]
+            var['weight_coord'][ w0:w1, : ] = weight_coord
+            var['weight_val'][ w0:w1 ] = obs['weight_val']
+        return None
+
+    def close( self ):
+        """finish writing the output file, returns the No. of obs written"""
+        if self.is_ncf is False:
+            save_list( [ self.domain ] + self.obs_list, self.filepath )
+            self.obs_list = []
+            return self.count
+        self.root.setncattr( 'OBS-SPCS', ''.join( [ '{:<16}'.format( s ) for s in self.spcs ] ) )
+        self.root.close()
+        return self.count
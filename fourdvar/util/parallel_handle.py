@@ -0,0 +1,57 @@
+"""
+parallel_handle.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import multiprocessing
+
+import fourdvar.params.data_access as data_access
+
+def get_pool( nproc ):
+    """
+    extension: get the shared pool of worker processes, created on first use
+    input: int (No. processes)
+    output: multiprocessing.Pool
+
+    notes: workers are forked when the pool is created, so they share any
+    data already set up (eg: ObservationData parameters) instead of copying it.
+    that data must not change while the pool exists, anything that changes it
+    must call close_pool (eg: ObservationData.from_file).
+    """
+    if data_access.pool is not None and data_access.pool_nproc != nproc:
+        close_pool()
+    if data_access.pool is None:
+        data_access.pool = multiprocessing.Pool( nproc )
+        data_access.pool_nproc = nproc
+    return data_access.pool
+
+def close_pool():
+    """
+    extension: shut down the shared pool of worker processes (if it exists)
+    input: None
+    output: None
+    """
+    if data_access.pool is not None:
+        data_access.pool.close()
+        data_access.pool.join()
+        data_access.pool = None
+        data_access.pool_nproc = None
+    return None
+
+def pool_map( func, arg_list, nproc=1 ):
+    """
+    extension: apply func to every argument, using the shared pool of nproc processes
+    input: function, list, int
+    output: list (results of func, same order as arg_list)
+
+    notes: func must be a module-level function, only args & results are copied
+    between processes. nproc <= 1 runs serially without a pool.
+    """
+    if nproc <= 1 or len( arg_list ) <= 1:
+        return [ func( arg ) for arg in arg_list ]
+    return get_pool( nproc ).map( func, arg_list, chunksize=1 )
@@ -0,0 +1,50 @@
+"""
+convert_obs_pickle.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os
+import glob
+
+import context
+import fourdvar.util.obs_handle as obs_handle
+from fourdvar.params.root_path_defn import store_path
+
+#-CONFIG-SETTINGS---------------------------------------------------------
+
+#list of zipped pickle obs files (or obs-lite archives) to convert
+#patterns are allowed (eg: 'archive/experiment/obs_lite_iter*.pic.gz')
+source = [ os.path.join( store_path, 'input/test_obs.pic.gz' ) ]
+
+#directory to save netCDF files in, None = same directory as source file
+output_dir = None
+
+#extensions removed from source filename before adding '.nc'
+pickle_ext = [ '.pic.gz', '.pickle.zip', '.pickle', '.gz' ]
+
+#--------------------------------------------------------------------------
+
+filelist = []
+for pattern in source:
+    filelist.extend( sorted( glob.glob( pattern ) ) )
+
+for fname in filelist:
+    src = os.path.realpath( fname )
+    name = os.path.basename( src )
+    for ext in pickle_ext:
+        if name.endswith( ext ):
+            name = name[ :-len(ext) ]
+            break
+    dst_dir = os.path.dirname( src ) if output_dir is None else output_dir
+    dst = os.path.join( dst_dir, name + '.nc' )
+    if obs_handle.is_ncf( src ):
+        print 'skip {}, already netCDF'.format( src )
+        continue
+    domain, obs = obs_handle.load_obs( src )
+    obs_handle.save_obs( dst, domain, obs )
+    print 'converted {} to {}'.format( src, dst )
@@ -8,13 +8,18 @@ Unless required by applicable law or agreed to in writing, software distributed
 See the License for the specific language governing permissions and limitations under the License.
 """
 
+import os
+import hashlib
+import cPickle as pickle
 import numpy as np
 import datetime as dt
+import calendar
 import pyproj
 from netCDF4 import Dataset
 from copy import deepcopy
+from collections import OrderedDict
 
-from ray_trace import Grid
+from ray_trace import Grid, Ray
 
 import fourdvar.params.cmaq_config as cmaq_config
 import fourdvar.params.template_defn as template_defn
@@ -34,6 +39,21 @@ class ModelSpace( object ):
                       'NROWS', 'NCOLS', 'NLAYS', 'VGTYP', 'VGTOP', 'VGLVLS',
                       'NVARS', 'VAR-LIST' ]
     
+    #No. of dates of surface pressure (PRSFC) held in memory (least recently used dropped)
+    psurf_cache_size = 4
+    #directory to save PRSFC of each date as .npy files, loaded memory-mapped
+    #(None = read PRSFC into memory from METCRO2D)
+    psurf_mmap_dir = None
+    #also hold pressure bounds of every cell for each cached date
+    #costs (NLAYS+1) times the memory of PRSFC, saves recalculating per obs
+    precompute_pbound = False
+    #directory to save the grid metadata and layer heights read from CONC & METCRO3D
+    #keyed by path, size & modification time of those files (None = no cache)
+    grid_cache_dir = None
+    #No. of ray footprints (cell weights of an exact ray geometry) held in memory
+    #only useful for instruments that repeat exact geometries (0 = no cache)
+    footprint_cache_size = 0
+    
     @classmethod
     def create_from_fourdvar( cls ):
         sdate = date_handle.start_date
@@ -51,18 +71,12 @@ class ModelSpace( object ):
         CONC = path to any concentration file output by CMAQ
         date_range = [ start_date, end_date ] (as datetime objects)
         """
-        #read netCDF files
-        self.gridmeta = {}
-        with Dataset( CONC, 'r' ) as f:
-            for key in self.gridmeta_keys:
-                self.gridmeta[ key ] = f.getncattr( key )
-        with Dataset( METCRO3D, 'r' ) as f:
-            zf = f.variables['ZF'][:].mean( axis=(0,2,3) )
-            layer_height = np.append( np.zeros(1), zf )
+        #read netCDF files (or their cached results)
+        self.gridmeta, layer_height, proj_str = self.read_grid( METCRO3D, CONC )
         
         self.psurf_file = METCRO2D
-        self.psurf_date = None
-        self.psurf_arr = None
+        self.psurf_cache = OrderedDict()
+        self.footprint_cache = OrderedDict()
         
         #date co-ords are int YYYYMMDD format
         self.sdate = int( date_range[0].strftime('%Y%m%d') )
@@ -93,15 +107,53 @@ class ModelSpace( object ):
         self.grid = Grid( offset, spacing )
         
         #construct projection for lat-lon conversion
+        self.proj = pyproj.Proj( proj_str )
+        return None
+    
+    @classmethod
+    def read_grid( cls, METCRO3D, CONC ):
+        """
+        return ( gridmeta, layer_height, proj_str ) read from CONC & METCRO3D
+        loaded from grid_cache_dir instead if those files are unchanged
+        """
+        cache_file = None
+        if cls.grid_cache_dir is not None:
+            key = hashlib.sha1()
+            for fname in [ METCRO3D, CONC ]:
+                fstat = os.stat( fname )
+                key.update( repr( ( os.path.realpath( fname ), fstat.st_size, fstat.st_mtime, ) ) )
+            cache_file = os.path.join( cls.grid_cache_dir, 'grid.{}.pickle'.format( key.hexdigest() ) )
+            if os.path.isfile( cache_file ):
+                with open( cache_file, 'rb' ) as f:
+                    return pickle.load( f )
+        
+        gridmeta = {}
+        with Dataset( CONC, 'r' ) as f:
+            for key in cls.gridmeta_keys:
+                gridmeta[ key ] = f.getncattr( key )
+        with Dataset( METCRO3D, 'r' ) as f:
+            zf = f.variables['ZF'][:].mean( axis=(0,2,3) )
+            layer_height = np.append( np.zeros(1), zf )
+        
         #assumes/forces use of LCC projection
-        assert ( self.gridmeta[ 'GDTYP' ] == 2 ), 'Invalid GDTYP'
-        alp = float( self.gridmeta[ 'P_ALP' ] )
-        bet = float( self.gridmeta[ 'P_BET' ] )
-        gam = float( self.gridmeta[ 'P_GAM' ] )
-        ycent = float( self.gridmeta[ 'YCENT' ] )
+        assert ( gridmeta[ 'GDTYP' ] == 2 ), 'Invalid GDTYP'
+        alp = float( gridmeta[ 'P_ALP' ] )
+        bet = float( gridmeta[ 'P_BET' ] )
+        gam = float( gridmeta[ 'P_GAM' ] )
+        ycent = float( gridmeta[ 'YCENT' ] )
         proj_str = '+proj=lcc +lat_1={0} +lat_2={1} +lat_0={3} +lon_0={2} +a={4} +b={4}'
-        self.proj = pyproj.Proj( proj_str.format( alp, bet, gam, ycent, earth_rad ) )
-        return None
+        proj_str = proj_str.format( alp, bet, gam, ycent, earth_rad )
+        
+        result = ( gridmeta, layer_height, proj_str, )
+        if cache_file is not None:
+            if not os.path.isdir( cls.grid_cache_dir ):
+                os.makedirs( cls.grid_cache_dir )
+            #write to a temporary file first, parallel workers may share the cache
+            tmp_file = '{}.{}.tmp'.format( cache_file, os.getpid() )
+            with open( tmp_file, 'wb' ) as f:
+                pickle.dump( result, f, pickle.HIGHEST_PROTOCOL )
+            os.rename( tmp_file, cache_file )
+        return result
     
     def valid_coord( self, coord ):
         """return True if a coord is within the grid"""
@@ -142,26 +194,50 @@ class ModelSpace( object ):
                            dt.timedelta(days=1) ).strftime('%Y%m%d') )
         return (cdate, cstep)
     
-    def update_psurf( self, date_int ):
-        #replace the psurf array with the new file
+    def read_psurf( self, date_int ):
+        #read the PRSFC array for date_int, memory-mapped if psurf_mmap_dir is set
         new_date = dt.datetime.strptime(str(date_int),'%Y%m%d')
         new_file = date_handle.replace_date( self.psurf_file, new_date )
-        with Dataset( new_file, 'r' ) as f:
-            self.psurf_arr = f.variables['PRSFC'][:,0,:,:]
-        self.psurf_date = date_int
-        return None
+        if self.psurf_mmap_dir is None:
+            with Dataset( new_file, 'r' ) as f:
+                return f.variables['PRSFC'][:,0,:,:]
+        mmap_file = os.path.join( self.psurf_mmap_dir, 'PRSFC.{}.npy'.format( date_int ) )
+        if ( not os.path.isfile( mmap_file ) or
+             os.path.getmtime( mmap_file ) < os.path.getmtime( new_file ) ):
+            if not os.path.isdir( self.psurf_mmap_dir ):
+                os.makedirs( self.psurf_mmap_dir )
+            with Dataset( new_file, 'r' ) as f:
+                psurf = np.asarray( f.variables['PRSFC'][:,0,:,:] )
+            #write to a temporary file first, parallel workers may share the mmap_dir
+            tmp_file = '{}.{}.tmp'.format( mmap_file, os.getpid() )
+            with open( tmp_file, 'wb' ) as f:
+                np.save( f, psurf )
+            os.rename( tmp_file, mmap_file )
+        return np.load( mmap_file, mmap_mode='r' )
     
-    def get_pressure_bounds( self, target_coord ):
-        date = target_coord[0]
-        time = target_coord[1]
-        row = target_coord[3]
-        col = target_coord[4]
-        if date != self.psurf_date:
-            self.update_psurf( date )
-        vgbot = self.psurf_arr[time,row,col]
+    def get_psurf( self, date_int ):
+        #return the cached entry for date_int { 'psurf':arr, 'pbound':arr or None }
+        if date_int in self.psurf_cache:
+            entry = self.psurf_cache.pop( date_int )
+        else:
+            entry = { 'psurf': self.read_psurf( date_int ), 'pbound': None }
+            if self.precompute_pbound is True:
+                entry[ 'pbound' ] = self.calc_pressure_bounds( entry[ 'psurf' ] )
+            while len( self.psurf_cache ) >= max( self.psurf_cache_size, 1 ):
+                self.psurf_cache.popitem( last=False )
+        #most recently used date is last
+        self.psurf_cache[ date_int ] = entry
+        return entry
+    
+    def calc_pressure_bounds( self, vgbot ):
+        #pressure bounds for an array of surface pressures, level is the last axis
         vglvl = np.array( self.gridmeta[ 'VGLVLS' ] )
         vgtop = float( self.gridmeta[ 'VGTOP' ] )
-        return ( vglvl[:]*(vgbot-vgtop) + vgtop )
+        vgbot = np.asarray( vgbot, dtype='float64' )[...,None]
+        return ( vglvl*(vgbot-vgtop) + vgtop )
+    
+    def get_pressure_bounds( self, target_coord ):
+        return self.get_pressure_bounds_batch( [ target_coord ] )[0]
     
     def get_pressure_weight( self, target_coord ):
         pbound = self.get_pressure_bounds( target_coord )
@@ -172,40 +248,88 @@ class ModelSpace( object ):
         pweight = pdiff / pbound[0]
         return pweight
     
+    def get_pressure_bounds_batch( self, coord_list ):
+        """vectorised get_pressure_bounds, returns array (ncoord,nlay+1)"""
+        coord_arr = np.array( [ c[:5] for c in coord_list ], dtype=int ).reshape(( -1, 5, ))
+        pbound = np.zeros(( coord_arr.shape[0], len( self.gridmeta[ 'VGLVLS' ] ), ))
+        for date in np.unique( coord_arr[:,0] ):
+            entry = self.get_psurf( int( date ) )
+            ind = ( coord_arr[:,0] == date )
+            time, row, col = coord_arr[ ind, 1 ], coord_arr[ ind, 3 ], coord_arr[ ind, 4 ]
+            if entry[ 'pbound' ] is not None:
+                pbound[ ind ] = entry[ 'pbound' ][ time, row, col ]
+            else:
+                pbound[ ind ] = self.calc_pressure_bounds( entry[ 'psurf' ][ time, row, col ] )
+        return pbound
+    
+    def get_pressure_weight_batch( self, coord_list ):
+        """vectorised get_pressure_weight, returns array (ncoord,nlay)"""
+        pbound = self.get_pressure_bounds_batch( coord_list )
+        #assign everything above the top layer to the top layer
+        pbound[:,-1] = 0.
+        #calculate pressure weight per layer
+        pdiff = pbound[:,:-1] - pbound[:,1:]
+        pweight = pdiff / pbound[:,0:1]
+        return pweight
+    
     def pressure_interp( self, obs_pressure, obs_value, target_coord ):
-        obs_pressure = np.array( obs_pressure )
-        obs_value = np.array( obs_value )
-        if np.all( np.diff( obs_pressure ) > 0. ):
-            pass
-        elif np.all( np.diff( obs_pressure ) < 0. ):
-            obs_pressure = obs_pressure[::-1]
-            obs_value = obs_value[::-1]
-        else:
+        return self.pressure_interp_batch( [ obs_pressure ], [ obs_value ], [ target_coord ] )[0]
+    
+    def pressure_interp_batch( self, obs_pressure, obs_value, coord_list ):
+        """interpolate many obs profiles onto the model layers in one call.
+        obs_pressure & obs_value = arrays (nobs,nlevel), one profile per target coord.
+        returns array (nobs,nlay) of values, surface-to-top.
+        values outside the obs pressure range are set to the nearest obs level."""
+        obs_pressure = np.array( obs_pressure, dtype='float64' ).reshape(( len(coord_list), -1, ))
+        obs_value = np.array( obs_value, dtype='float64' ).reshape( obs_pressure.shape )
+        is_inc = np.all( np.diff( obs_pressure, axis=1 ) > 0., axis=1 )
+        is_dec = np.all( np.diff( obs_pressure, axis=1 ) < 0., axis=1 )
+        if not np.all( is_inc | is_dec ):
             raise ValueError('obs pressure levels not in sorted order!')
-        cmaq_pbound = self.get_pressure_bounds( target_coord )
-        #interpolate from low pressure to high then flip back afterwards
-        cmaq_plvl = 0.5 * (cmaq_pbound[:-1]+cmaq_pbound[1:])[::-1]
-        assert np.all( np.diff(cmaq_plvl) > 0. )
-        cmaq_val = np.zeros( cmaq_plvl.size )
-        for cmaq_i,p in enumerate( cmaq_plvl ):
-            if p <= obs_pressure[0]:
-                cmaq_val[cmaq_i] = obs_value[0]
-            elif p >= obs_pressure[-1]:
-                cmaq_val[cmaq_i] = obs_value[-1]
-            else:
-                i = np.searchsorted( obs_pressure, p )
-                obs_p_low = obs_pressure[i-1]
-                obs_p_high = obs_pressure[i]
-                obs_v_low = obs_value[i-1]
-                obs_v_high = obs_value[i]
-                pos = (p-obs_p_low) / (obs_p_high-obs_p_low)
-                cmaq_val[cmaq_i] = obs_v_low + pos * (obs_v_high-obs_v_low)
-        #flip cmaq_val back so values are surface-to-top
-        return cmaq_val[::-1]
+        obs_pressure[ ~is_inc ] = obs_pressure[ ~is_inc, ::-1 ]
+        obs_value[ ~is_inc ] = obs_value[ ~is_inc, ::-1 ]
+        cmaq_pbound = self.get_pressure_bounds_batch( coord_list )
+        #model levels are surface-to-top (high pressure to low)
+        cmaq_plvl = 0.5 * (cmaq_pbound[:,:-1]+cmaq_pbound[:,1:])
+        assert np.all( np.diff(cmaq_plvl,axis=1) < 0. )
+        
+        #index of first obs level >= each model level (searchsorted per profile)
+        nlevel = obs_pressure.shape[1]
+        i = ( obs_pressure[:,None,:] < cmaq_plvl[:,:,None] ).sum( axis=2 )
+        i = np.clip( i, 1, max( nlevel-1, 1 ) )
+        prof = np.arange( obs_pressure.shape[0] )[:,None]
+        obs_p_low = obs_pressure[ prof, i-1 ]
+        obs_p_high = obs_pressure[ prof, np.minimum( i, nlevel-1 ) ]
+        obs_v_low = obs_value[ prof, i-1 ]
+        obs_v_high = obs_value[ prof, np.minimum( i, nlevel-1 ) ]
+        with np.errstate( divide='ignore', invalid='ignore' ):
+            pos = (cmaq_plvl-obs_p_low) / (obs_p_high-obs_p_low)
+        cmaq_val = obs_v_low + pos * (obs_v_high-obs_v_low)
+        cmaq_val = np.where( cmaq_plvl <= obs_pressure[:,:1], obs_value[:,:1], cmaq_val )
+        cmaq_val = np.where( cmaq_plvl >= obs_pressure[:,-1:], obs_value[:,-1:], cmaq_val )
+        return cmaq_val
     
     def get_xy( self, lat, lon ):
         return self.proj( lon, lat )
     
+    def inside_xy( self, x, y ):
+        """vectorised test of which (x,y) points are inside the horizontal grid"""
+        x, y = np.asarray( x ), np.asarray( y )
+        xedge, yedge = self.grid.edges[0], self.grid.edges[1]
+        in_x = ( min( xedge[0], xedge[-1] ) <= x ) & ( x <= max( xedge[0], xedge[-1] ) )
+        in_y = ( min( yedge[0], yedge[-1] ) <= y ) & ( y <= max( yedge[0], yedge[-1] ) )
+        return in_x & in_y
+    
+    def inside_date_range( self, unix_time ):
+        """vectorised test of which unix timestamps could be in the date range
+        (times in the first step after edate map to the last step of edate)"""
+        sday = dt.datetime.strptime( str( self.sdate ), '%Y%m%d' )
+        eday = dt.datetime.strptime( str( self.edate ), '%Y%m%d' ) + dt.timedelta( days=1 )
+        start = calendar.timegm( sday.timetuple() )
+        end = calendar.timegm( eday.timetuple() ) + tosec( self.gridmeta[ 'TSTEP' ] )
+        unix_time = np.asarray( unix_time )
+        return ( start <= unix_time ) & ( unix_time < end )
+    
     def get_ray_top( self, start, zenith, azimuth ):
         """get the (x,y,z) point where a ray leaves the top of the model
         start = (x,y,z) start point
@@ -225,6 +349,48 @@ class ModelSpace( object ):
         top_point = ( x0+xd, y0+yd, self.max_height )
         return top_point
     
+    def calc_footprint( self, point_list ):
+        """weight of each (lay,row,col) cell along the piecewise-straight path
+        through point_list (a list of (x,y,z) points), None if outside the grid"""
+        ray_list = []
+        for start, end in zip( point_list[:-1], point_list[1:] ):
+            ray_list.append( Ray( start, end ) )
+        total = sum( r.length for r in ray_list )
+        frac_list = [ float(r.length)/total for r in ray_list ]
+        
+        #add up each component ray
+        total_dict = {}
+        for ray_path, frac in zip( ray_list, frac_list ):
+            try:
+                r_dict = self.grid.get_weight( ray_path )
+            except AssertionError:
+                return None
+            for k,v in r_dict.items():
+                prev = total_dict.get( k, 0 )
+                total_dict[ k ] = prev + v*frac
+        
+        #convert x-y-z into lay-row-col
+        return { (lay,row,col):val for [(col,row,lay,),val]
+                 in total_dict.items() if val > 0.0 }
+    
+    def get_footprint( self, point_list ):
+        """calc_footprint, reusing the result for a previously seen exact geometry
+        (eg: fixed-geometry instruments), returns a copy of any cached footprint"""
+        if self.footprint_cache_size <= 0:
+            return self.calc_footprint( point_list )
+        key = tuple( tuple( float(c) for c in p ) for p in point_list )
+        if key in self.footprint_cache:
+            footprint = self.footprint_cache.pop( key )
+        else:
+            footprint = self.calc_footprint( point_list )
+            while len( self.footprint_cache ) >= max( self.footprint_cache_size, 1 ):
+                self.footprint_cache.popitem( last=False )
+        #most recently used footprint is last
+        self.footprint_cache[ key ] = footprint
+        if footprint is None:
+            return None
+        return dict( footprint )
+    
     def get_domain( self ):
         domain = deepcopy( self.gridmeta )
         domain['SDATE'] = self.sdate
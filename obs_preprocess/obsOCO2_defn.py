@@ -16,7 +16,9 @@ from obs_defn import ObsMultiRay
 class ObsOCO2( ObsMultiRay ):
     """Single observation (or sounding) from OCO2 satellite
     This observation class only works for 1 species.
+    src_data is released once the weight_grid is built.
     """
+    __slots__ = [ 'src_data' ]
     required = ['value','uncertainty','weight_grid','offset_term']
     
     @classmethod
@@ -49,11 +51,36 @@ class ObsOCO2( ObsMultiRay ):
         #newobs.out_dict['operation_mode'] = kwargs['operation_mode']
         #OCO2 Lite-files only record CO2 values
         newobs.spcs = 'CO2'
-        newobs.src_data = kwargs.copy()
+        #kwargs is already a new dict, no need to copy it
+        newobs.src_data = kwargs
         return newobs
     
     def model_process( self, model_space ):
         ObsMultiRay.model_process( self, model_space )
+        self.set_lite_coord()
+        self.src_data = None
+        return None
+    
+    @classmethod
+    def model_process_batch( cls, obs_list, model_space ):
+        """model_process a list of soundings,
+        visibility of every valid sounding is calculated in one batch."""
+        prop_list = [ obs.get_proportion( model_space ) for obs in obs_list ]
+        valid = [ (obs,prop) for obs,prop in zip( obs_list, prop_list ) if obs.valid is True ]
+        if len( valid ) > 0:
+            vis_arr, offset_arr = cls.get_visibility_batch( [ obs for obs,_ in valid ],
+                                                            [ prop for _,prop in valid ],
+                                                            model_space )
+            for (obs,prop), model_vis, offset in zip( valid, vis_arr, offset_arr ):
+                obs.out_dict['offset_term'] = offset
+                weight_grid = obs.get_layer_weight( prop, model_vis )
+                obs.set_weight_grid( weight_grid, prop, model_space )
+                obs.set_lite_coord()
+        for obs in obs_list:
+            obs.src_data = None
+        return None
+    
+    def set_lite_coord( self ):
         #set lite_coord to surface cell with largest weight
         if 'weight_grid' in self.out_dict.keys():
             surf = [ (v,k) for k,v in self.out_dict['weight_grid'].items()
@@ -62,30 +89,42 @@ class ObsOCO2( ObsMultiRay ):
         return None
     
     def add_visibility( self, proportion, model_space ):
+        vis_arr, offset_arr = self.get_visibility_batch( [ self ], [ proportion ], model_space )
+        self.out_dict['offset_term'] = offset_arr[0]
+        return self.get_layer_weight( proportion, vis_arr[0] )
+    
+    @classmethod
+    def get_visibility_batch( cls, obs_list, prop_list, model_space ):
+        """model layer visibility & offset_term of many soundings.
+        returns array (nobs,nlay) of visibility, array (nobs) of offset_term.
+        all soundings must have the same No. of pressure levels."""
+        src_list = [ obs.src_data for obs in obs_list ]
         #obs pressure is in hPa, convert to model units (Pa)
-        obs_pressure = 100. * np.array( self.src_data[ 'pressure_levels' ] )
-        obs_kernel = np.array( self.src_data[ 'xco2_averaging_kernel' ] )
-        obs_apriori = np.array( self.src_data[ 'co2_profile_apriori' ] )
+        obs_pressure = 100. * np.array( [ src[ 'pressure_levels' ] for src in src_list ] )
+        obs_kernel = np.array( [ src[ 'xco2_averaging_kernel' ] for src in src_list ] )
+        obs_apriori = np.array( [ src[ 'co2_profile_apriori' ] for src in src_list ] )
+        xco2_apriori = np.array( [ src[ 'xco2_apriori' ] for src in src_list ] )
         
         #get sample model coordinate at surface
-        coord = [ c for c in proportion.keys() if c[2] == 0 ][0]
+        coord_list = [ [ c for c in prop.keys() if c[2] == 0 ][0] for prop in prop_list ]
         
-        model_pweight = model_space.get_pressure_weight( coord )
-        model_kernel = model_space.pressure_interp( obs_pressure, obs_kernel, coord )
-        model_apriori = model_space.pressure_interp( obs_pressure, obs_apriori, coord )
+        model_pweight = model_space.get_pressure_weight_batch( coord_list )
+        model_kernel = model_space.pressure_interp_batch( obs_pressure, obs_kernel, coord_list )
+        model_apriori = model_space.pressure_interp_batch( obs_pressure, obs_apriori, coord_list )
         
         model_vis = model_pweight * model_kernel
         column_xco2 = ( model_pweight * model_kernel * model_apriori )
-        self.out_dict['offset_term'] = self.src_data['xco2_apriori'] - column_xco2.sum()
-        
-        weight_grid = {}
-        for l, weight in enumerate( model_vis ):
-            layer_slice = { c:v for c,v in proportion.items() if c[2] == l }
-            layer_sum = sum( layer_slice.values() )
-            weight_slice = { c: weight*v/layer_sum for c,v in layer_slice.items() }
-            weight_grid.update( weight_slice )
-        
-        return weight_grid
+        offset = xco2_apriori - column_xco2.sum( axis=1 )
+        return model_vis, offset
+    
+    def get_layer_weight( self, proportion, model_vis ):
+        """split the visibility of each layer between the cells of that layer"""
+        coord_list = proportion.keys()
+        prop = np.array( [ proportion[ c ] for c in coord_list ] )
+        lay = np.array( [ c[2] for c in coord_list ], dtype=int )
+        layer_sum = np.bincount( lay, weights=prop, minlength=model_vis.size )
+        weight = model_vis[ lay ] * prop / layer_sum[ lay ]
+        return dict( zip( coord_list, weight.tolist() ) )
     
     def map_location( self, model_space ):
         assert model_space.gridmeta['GDTYP'] == 2, 'invalid GDTYP'
@@ -9,11 +9,13 @@ See the License for the specific language governing permissions and limitations
 """
 
 import numpy as np
-from obs_preprocess.ray_trace import Point, Ray
-from copy import deepcopy
+from obs_preprocess.ray_trace import Point
 
 class ObsGeneral( object ):
-    """base class for observations."""
+    """base class for observations.
+    attributes are declared in __slots__ to keep each obs small,
+    subclasses must declare __slots__ for any new attributes."""
+    __slots__ = [ 'id', 'out_dict', 'ready', 'valid', 'fail_reason' ]
     count = 0
     #required attributes must be defined in out_dict
     required = ['value','uncertainty','weight_grid']
@@ -41,7 +43,8 @@ class ObsGeneral( object ):
             if attr not in keys:
                 print '{:} not defined, setting to {:}'.format(attr,val)
                 self.out_dict[ attr ] = val
-        return deepcopy( self.out_dict )
+        #shallow copy, values (eg: weight_grid) are shared with this obs
+        return dict( self.out_dict )
     
     def model_process( self, model_space ):
         msg = 'class {} must overload construct method'
@@ -52,6 +55,7 @@ class ObsSimple( ObsGeneral ):
     """Simple observation for testing.
     Instant point measurement
     Provided with co-ordinate already mapped into model grid."""
+    __slots__ = [ 'cell' ]
     @classmethod
     def create( cls, cell, value, uncertainty ):
         newobs = cls( obstype='Simple' )
@@ -81,6 +85,7 @@ class ObsStationary( ObsSimple ):
     eg: rooftop equipment.
     See map_time & map_location methods for input assumptions
     """
+    __slots__ = [ 'time', 'location', 'spcs' ]
     @classmethod
     def create( cls, time, loc, spcs, value, uncertainty ):
         newobs = cls( obstype='Stationary' )
@@ -195,6 +200,7 @@ class ObsInstantRay( ObsSimple ):
     See map_time & map_location methods for input assumptions
     Only works for 1 species
     """
+    __slots__ = [ 'time', 'location', 'spcs', 'interp_time' ]
     @classmethod
     def create( cls, time, loc, spcs, value, uncertainty ):
         newobs = cls( obstype='InstantRay' )
@@ -208,6 +214,19 @@ class ObsInstantRay( ObsSimple ):
     def model_process( self, model_space ):
         """Process the observation with the models parameters"""
         
+        proportion = self.get_proportion( model_space )
+        if self.valid is False: return None
+        
+        weight_grid = self.add_visibility( proportion, model_space )
+        if self.valid is False: return None
+        
+        self.set_weight_grid( weight_grid, proportion, model_space )
+        return None
+    
+    def get_proportion( self, model_space ):
+        """Combine map_location & map_time into dictionary where
+        key   = model_space co-ordinate,
+        value = proportion of observation."""
         if self.spcs not in model_space.spcs:
             self.coord_fail( 'invalid spcs' )
             return None
@@ -223,10 +242,10 @@ class ObsInstantRay( ObsSimple ):
             for loc_k, loc_v in loc_dict.items():
                 coord = time_k + loc_k + (self.spcs,)
                 proportion[ coord ] = time_v * loc_v
-        
-        weight_grid = self.add_visibility( proportion, model_space )
-        if self.valid is False: return None
-        
+        return proportion
+    
+    def set_weight_grid( self, weight_grid, proportion, model_space ):
+        """Check weight_grid is inside the model and record it"""
         #dicts must have identical keys
         assert set( weight_grid ) == set( proportion )
         for key in weight_grid.keys():
@@ -277,18 +296,10 @@ class ObsInstantRay( ObsSimple ):
         #assume self.location = [ loc_start, loc_end ]
         #assume loc recorded in (x,y,z) co-ordinates.
         assert model_space.gridmeta['GDTYP'] == 2, 'invalid GDTYP'
-        loc_start,loc_end = self.location
-        ray_path = Ray( loc_start, loc_end )
-        try:
-            xyz_dict = model_space.grid.get_weight( ray_path )
-        except AssertionError:
+        result = model_space.get_footprint( self.location )
+        if result is None:
             self.coord_fail( 'outside grid area' )
             return None
-        #convert x-y-z into lay-row-col
-        result = { (lay,row,col):val
-                   for [(col,row,lay,),val]
-                   in xyz_dict.items() 
-                   if val > 0.0}
         return result
     
     def add_visibility( self, proportion, model_space ):
@@ -301,6 +312,7 @@ class ObsMultiRay( ObsInstantRay ):
     Uses model_process, map_time & add_visibility from obsInstantRay
     only works for 1 species
     """
+    __slots__ = []
     @classmethod
     def create( cls, time, loc, spcs, value, uncertainty ):
         newobs = cls( obstype='MultiRay' )
@@ -318,25 +330,8 @@ class ObsMultiRay( ObsInstantRay ):
         #assume self.location = [ point_0, point_1, ..., point_n ]
         #assume point recorded in (x,y,z) co-ordinates.
         assert model_space.gridmeta['GDTYP'] == 2, 'invalid GDTYP'
-        ray_list = []
-        for start, end in zip( self.location[:-1], self.location[1:] ):
-            ray_list.append( Ray( start, end ) )
-        total = sum( r.length for r in ray_list )
-        frac_list = [ float(r.length)/total for r in ray_list ]
-        
-        #add up each component ray
-        total_dict = {}
-        for ray_path, frac in zip( ray_list, frac_list ):
-            try:
-                r_dict = model_space.grid.get_weight( ray_path )
-            except AssertionError:
-                self.coord_fail( 'outside grid area' )
-                return None
-            for k,v in r_dict.items():
-                prev = total_dict.get( k, 0 )
-                total_dict[ k ] = prev + v*frac
-            
-        #convert x-y-z into lay-row-col
-        result = { (lay,row,col):val for [(col,row,lay,),val]
-                   in total_dict.items() if val > 0.0 }
+        result = model_space.get_footprint( self.location )
+        if result is None:
+            self.coord_fail( 'outside grid area' )
+            return None
         return result
@@ -9,13 +9,20 @@ See the License for the specific language governing permissions and limitations
 """
 
 import os
+import calendar
+import datetime as dt
 import glob
+import hashlib
+import multiprocessing
 
 import context
 from obsOCO2_defn import ObsOCO2
-from model_space import ModelSpace
+from model_space import ModelSpace, tosec
+from collections import OrderedDict
+from super_obs import add_obs, pop_closed
+from prune_obs import prune_obs
 from netCDF4 import Dataset
-import fourdvar.util.file_handle as fh
+import fourdvar.util.obs_handle as obs_handle
 from fourdvar.params.root_path_defn import share_path
 import fourdvar.params.input_defn as input_defn
 
@@ -30,6 +37,39 @@ source = os.path.join( share_path, 'obs_oco2_data' )
 
 output_file = input_defn.obs_file
 
+#merge soundings that share a model column & timestep into super-observations
+#groups are merged across chunks & files, a group is only written once no chunk
+#left to process has a sounding before the end of its timestep (any sounding order).
+#chunks are processed in order of their earliest sounding (as sort_by_date)
+#so finished groups can be written early
+super_obs = False
+
+#drop the smallest weights of each obs, up to this fraction of its weight mass
+#the rest are rescaled, the mass removed is recorded as pruned_mass (0. = no pruning)
+prune_tolerance = 0.
+
+#No. of processes used to read & process files (1 = serial)
+nproc = 1
+
+#No. of soundings read & processed at a time (per process)
+#peak memory is set by chunk_size, not by the No. of files
+chunk_size = 10000
+
+#process chunks in order of their earliest sounding, so dates are read from
+#the ModelSpace PRSFC cache as often as possible (changes the output order)
+#only whole chunks are reordered: soundings keep their file order within a chunk
+#and chunks that overlap in time are not merged, so the output is not strictly by date
+sort_by_date = False
+
+#soundings with a larger warn_level are discarded (None = keep all)
+max_warn_level = None
+
+#directory to cache the processed obs of each source file in (None = no cache)
+#a file is only processed again if it, the model grid & dates or max_warn_level
+#change (changes to the MET files are not detected, clear the cache for those).
+#cached obs are read back chunk_size at a time, ordered by timestep as sort_by_date
+cache_dir = None
+
 #--------------------------------------------------------------------------
 
 model_grid = ModelSpace.create_from_fourdvar()
@@ -61,31 +101,168 @@ root_var = [ 'sounding_id',
              'xco2_averaging_kernel',
              'pressure_weight' ]
 sounding_var = [ 'solar_azimuth_angle', 'sensor_azimuth_angle' ]
-obslist = []
-for fname in filelist:
-    print 'read {}'.format( fname )
+def process_chunk( ( fname, start, end ) ):
+    """read soundings [start:end] of an OCO2-Lite file and return a list of valid obs dicts"""
     var_dict = {}
     with Dataset( fname, 'r' ) as f:
-        size = f.dimensions[ 'sounding_id' ].size
         for var in root_var:
-            var_dict[ var ] = f.variables[ var ][:]
+            var_dict[ var ] = f.variables[ var ][ start:end ]
         for var in sounding_var:
-            var_dict[ var ] = f.groups[ 'Sounding' ].variables[ var ][:]
-    print 'found {} soundings'.format( size )
+            var_dict[ var ] = f.groups[ 'Sounding' ].variables[ var ][ start:end ]
+    
+    #vectorised prefilter, before any ObsOCO2 is created
+    keep = model_grid.inside_date_range( var_dict[ 'time' ] )
+    if max_warn_level is not None:
+        keep &= ( var_dict[ 'warn_level' ] <= max_warn_level )
+    x, y = model_grid.get_xy( var_dict[ 'latitude' ], var_dict[ 'longitude' ] )
+    keep &= model_grid.inside_xy( x, y )
+    var_dict = { k: v[ keep ] for k,v in var_dict.items() }
     
-    for i in range( size ):
+    chunk_obs = []
+    for i in range( keep.sum() ):
         src_dict = { k: v[i] for k,v in var_dict.items() }
         obs = ObsOCO2.create( **src_dict )
         obs.interp_time = False
-        obs.model_process( model_grid )
-        if obs.valid is True:
-            obslist.append( obs.get_obsdict() )
-
-if len( obslist ) > 0:
-    domain = model_grid.get_domain()
-    domain['is_lite'] = False
-    datalist = [ domain ] + obslist
-    fh.save_list( datalist, output_file )
-    print 'recorded observations to {}'.format( output_file )
+        chunk_obs.append( obs )
+    ObsOCO2.model_process_batch( chunk_obs, model_grid )
+    obslist = [ obs.get_obsdict() for obs in chunk_obs if obs.valid is True ]
+    print 'read {} soundings [{}:{}], {} valid'.format( fname, start, end, len( obslist ) )
+    return obslist
+
+def get_cache_file( fname ):
+    """path to the processed-obs cache of a source file"""
+    key = hashlib.sha1()
+    with open( fname, 'rb' ) as f:
+        for block in iter( lambda: f.read( 2**20 ), '' ):
+            key.update( block )
+    key.update( repr( sorted( model_grid.get_domain().items() ) ) )
+    key.update( repr( max_warn_level ) )
+    return os.path.join( cache_dir, key.hexdigest() + '.nc' )
+
+todo_list = filelist
+if cache_dir is not None:
+    cache_file = { fname: get_cache_file( fname ) for fname in filelist }
+    todo_list = [ fname for fname in filelist if not os.path.isfile( cache_file[ fname ] ) ]
+    print '{} of {} files found in cache'.format( len(filelist)-len(todo_list), len(filelist) )
+
+#split every file into chunks of (at most) chunk_size soundings
+chunk_list = []
+for fname in todo_list:
+    with Dataset( fname, 'r' ) as f:
+        size = f.dimensions[ 'sounding_id' ].size
+    print 'found {} soundings in {}'.format( size, fname )
+    chunk_list.extend( [ ( fname, start, min( start+chunk_size, size ), )
+                         for start in range( 0, size, chunk_size ) ] )
+#earliest sounding time of each chunk (only needed when sorting chunks)
+chunk_time = {}
+if sort_by_date is True or super_obs is True:
+    for fname, start, end in chunk_list:
+        with Dataset( fname, 'r' ) as f:
+            chunk_time[ ( fname, start, end, ) ] = float( f.variables[ 'time' ][ start:end ].min() )
+    chunk_list.sort( key=lambda chunk: chunk_time[ chunk ] )
+
+def remaining_time( time_list ):
+    """earliest time of all chunks after each chunk (inf = no more soundings)"""
+    rest = len( time_list ) * [ float( 'inf' ) ]
+    for i in range( len( time_list )-2, -1, -1 ):
+        rest[ i ] = min( rest[ i+1 ], time_list[ i+1 ] )
+    return rest
+rest_time = remaining_time( [ chunk_time.get( chunk, float( 'inf' ) ) for chunk in chunk_list ] )
+
+domain = model_grid.get_domain()
+domain['is_lite'] = False
+writer = obs_handle.ObsWriter( output_file, domain )
+
+#super-observation groups that may still get more soundings
+open_groups = OrderedDict()
+tsec = tosec( model_grid.gridmeta[ 'TSTEP' ] )
+def step_start( key ):
+    """unix time at the start of the timestep of a lite_coord or super-obs group"""
+    date, step = int( key[0] ), int( key[1] )
+    day = calendar.timegm( dt.datetime.strptime( str( date ), '%Y%m%d' ).timetuple() )
+    return day + tosec( model_grid.gridmeta[ 'STIME' ] ) + step * tsec
+
+def group_end( key ):
+    """unix time at the end of the timestep of a super-obs group"""
+    return step_start( key ) + tsec
+
+def write_obs( obslist, next_time ):
+    """add obs dicts to the output file (merging super-observations & pruning weights)
+    next_time = earliest time of any sounding still to come (inf = no more soundings)"""
+    if super_obs is True:
+        nsounding = len( obslist )
+        add_obs( open_groups, obslist )
+        obslist = pop_closed( open_groups, lambda key: group_end( key ) <= next_time )
+        msg = 'merged {} soundings, wrote {} super-observations, {} still open'
+        print msg.format( nsounding, len( obslist ), len( open_groups ) )
+    if prune_tolerance > 0. and len( obslist ) > 0:
+        nweight = sum( len( o['weight_grid'] ) for o in obslist )
+        obslist = prune_obs( obslist, prune_tolerance )
+        removed = [ o['pruned_mass'] for o in obslist ]
+        msg = 'pruned {} of {} weights, mass removed: mean {:.3g}, max {:.3g}'
+        print msg.format( nweight - sum( len( o['weight_grid'] ) for o in obslist ),
+                          nweight, sum( removed ) / len( removed ), max( removed ) )
+    writer.append( obslist )
+    return None
+
+#chunks left to process for each file
+chunk_count = {}
+for fname, start, end in chunk_list:
+    chunk_count[ fname ] = chunk_count.get( fname, 0 ) + 1
+cache_writer = {}
+if nproc > 1 and len( chunk_list ) > 1:
+    #workers are forked, each gets its own copy of model_grid.
+    #equal sized chunks balance the work between processes,
+    #imap returns results in chunk order (same output as a serial run).
+    pool = multiprocessing.Pool( min( nproc, len( chunk_list ) ) )
+    result_iter = pool.imap( process_chunk, chunk_list, chunksize=1 )
+else:
+    pool = None
+    result_iter = ( process_chunk( chunk ) for chunk in chunk_list )
+try:
+    for i, ( ( fname, start, end ), obslist ) in enumerate( zip( chunk_list, result_iter ) ):
+        if cache_dir is None:
+            write_obs( obslist, rest_time[ i ] )
+            continue
+        #cache is written to a tmp file, only renamed once the file is complete
+        tmp_file = os.path.join( cache_dir, 'tmp.' + os.path.basename( cache_file[ fname ] ) )
+        if fname not in cache_writer:
+            cache_writer[ fname ] = obs_handle.ObsWriter( tmp_file, domain )
+        cache_writer[ fname ].append( obslist )
+        chunk_count[ fname ] -= 1
+        if chunk_count[ fname ] == 0:
+            cache_writer.pop( fname ).close()
+            os.rename( tmp_file, cache_file[ fname ] )
+finally:
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+if cache_dir is not None:
+    #merge the cache of every source file into the output, one chunk at a time
+    cache_chunk = []
+    for fname in filelist:
+        if not os.path.isfile( cache_file[ fname ] ):
+            #file has no soundings
+            continue
+        size = len( obs_handle.ArrayColumn( cache_file[ fname ], 'lite_coord' ) )
+        cache_chunk.extend( [ ( cache_file[ fname ], start, start+chunk_size, )
+                              for start in range( 0, size, chunk_size ) ] )
+    if sort_by_date is True or super_obs is True:
+        for cname, start, end in cache_chunk:
+            #a sounding is never before the start of its (date,step)
+            obs_step = obs_handle.ArrayColumn( cname, 'lite_coord' )[ start:end, :2 ]
+            chunk_time[ ( cname, start, end, ) ] = step_start( min( map( tuple, obs_step ) ) )
+        cache_chunk.sort( key=lambda chunk: chunk_time[ chunk ] )
+    rest_time = remaining_time( [ chunk_time.get( chunk, float( 'inf' ) ) for chunk in cache_chunk ] )
+    for ( cname, start, end ), next_time in zip( cache_chunk, rest_time ):
+        cache_obs = obs_handle.load_columns( cname, start, end )
+        write_obs( obs_handle.columns_to_obslist( cache_obs ), next_time )
+nobs = writer.close()
+
+if nobs > 0:
+    print 'recorded {} observations to {}'.format( nobs, output_file )
 else:
+    if os.path.isfile( output_file ):
+        os.remove( output_file )
     print 'No valid observations found, no output file generated.'
@@ -0,0 +1,59 @@
+"""
+prune_obs.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import numpy as np
+
+def prune_weight_grid( weight_grid, tolerance, keep_coord=None ):
+    """
+    extension: drop the smallest weights of a weight_grid
+    input: dict (weight_grid), float (relative mass tolerance), tuple (coord never dropped)
+    output: ( dict (pruned weight_grid), float (fraction of mass removed) )
+
+    notes: weights are dropped smallest first while the removed mass
+    (sum of abs values) is at most tolerance * total mass.
+    remaining weights are rescaled to keep the sum of the weight_grid.
+    """
+    coord_list = weight_grid.keys()
+    val = np.array( [ weight_grid[ c ] for c in coord_list ], dtype='float64' )
+    mass = np.abs( val )
+    total = mass.sum()
+    if tolerance <= 0. or total <= 0.:
+        return weight_grid, 0.
+    order = np.argsort( mass, kind='mergesort' )
+    drop = np.zeros( val.size, dtype=bool )
+    drop[ order ] = ( np.cumsum( mass[ order ] ) <= tolerance * total )
+    if keep_coord in weight_grid:
+        drop[ coord_list.index( keep_coord ) ] = False
+    if not drop.any():
+        return weight_grid, 0.
+    kept_sum = val[ ~drop ].sum()
+    scale = val.sum() / kept_sum if kept_sum != 0. else 1.
+    result = { c: v*scale for c, v, d in zip( coord_list, val.tolist(), drop ) if not d }
+    return result, float( mass[ drop ].sum() / total )
+
+def prune_obs( obslist, tolerance ):
+    """
+    extension: prune the weight_grid of every obs dict
+    input: list of dicts (obs dicts), float (relative mass tolerance)
+    output: list of dicts (pruned obs dicts, with 'pruned_mass' added)
+
+    notes: the lite_coord of each obs is never dropped.
+    pruned_mass (fraction of weight mass removed) is kept in the obs misc_meta
+    so the approximation error of every obs stays visible.
+    """
+    result = []
+    for odict in obslist:
+        weight_grid, removed = prune_weight_grid( odict[ 'weight_grid' ], tolerance,
+                                                  odict.get( 'lite_coord', None ) )
+        odict = dict( odict )
+        odict[ 'weight_grid' ] = weight_grid
+        odict[ 'pruned_mass' ] = removed
+        result.append( odict )
+    return result
@@ -48,26 +48,80 @@ class Grid( object ):
         [ind1,ind2] = sorted([ind1,ind2])
         return self.edges[ dim ][ ind1:ind2 ]
     
-    def get_ray_cell_dist( self, ray ):
-        assert ray.ndim == self.ndim, 'dimension mis-match'
-        ray_par_list = []
+    def get_cell_1d_array( self, value_arr, dim ):
+        """vectorised get_cell_1d, value_arr is an array of values in dimension dim"""
+        assert 0 <= dim < self.ndim, 'invalid dimension'
+        value_arr = np.asarray( value_arr )
+        sign = np.sign(self.edges[dim][-1] - self.edges[dim][0])
+        edge_arr = self.edges[dim]
+        if sign < 0:
+            edge_arr = edge_arr[::-1]
+        msg = 'value outside grid'
+        assert ((edge_arr[0] <= value_arr) & (value_arr <= edge_arr[-1])).all(), msg
+        result = np.searchsorted( edge_arr, value_arr ) - 1
+        result = np.clip( result, 0, self.shape[ dim ] - 1 )
+        if sign < 0:
+            result = self.shape[dim]-1 - result
+        return result
+    
+    def get_ray_cell_dist_batch( self, start_arr, end_arr ):
+        """path length of many rays through every cell they cross.
+        start_arr & end_arr are arrays (nray,ndim) of ray start/end points.
+        returns ( ptr (nray+1), cell (ncross,ndim), dist (ncross) ),
+        ray i crosses cell[ ptr[i]:ptr[i+1] ] for dist[ ptr[i]:ptr[i+1] ].
+        All rays are traversed together (parametric Amanatides-Woo style):
+        the ray parameter of every edge crossing is found per dimension,
+        crossings are sorted along each ray and each segment is mapped to a cell."""
+        start_arr = np.atleast_2d( np.asarray( start_arr, dtype='float64' ) )
+        end_arr = np.atleast_2d( np.asarray( end_arr, dtype='float64' ) )
+        assert start_arr.shape == end_arr.shape, 'start & end mis-match'
+        nray, ndim = start_arr.shape
+        assert ndim == self.ndim, 'dimension mis-match'
+        delta = end_arr - start_arr
+        length = np.sqrt( ( delta**2 ).sum( axis=1 ) )
+        
+        #every ray starts at par=0 and ends at par=1
+        ray_list = [ np.arange( nray ), np.arange( nray ) ]
+        par_list = [ np.zeros( nray ), np.ones( nray ) ]
         for dim in range( self.ndim ):
-            edge_collision = self.get_collision_1d( ray, dim )
-            ray_par_list.extend( [ ray.get_par( edge, dim ) for edge in edge_collision ] )
-        ray_par_list.sort()
-        assert ray_par_list[0] >= 0, 'collision outside ray path'
-        assert ray_par_list[-1] <= 1, 'collision outside ray path'
-        ray_par_list.insert( 0, 0 )
-        ray_par_list.append( 1 )
-        point_list = [ ray.get_point( par ) for par in ray_par_list ]
+            ind1 = self.get_cell_1d_array( np.minimum( start_arr[:,dim], end_arr[:,dim] ), dim ) + 1
+            ind2 = self.get_cell_1d_array( np.maximum( start_arr[:,dim], end_arr[:,dim] ), dim ) + 1
+            ind1, ind2 = np.minimum( ind1, ind2 ), np.maximum( ind1, ind2 )
+            count = ind2 - ind1
+            ray_ind = np.repeat( np.arange( nray ), count )
+            step = np.arange( count.sum() ) - np.repeat( np.cumsum( count ) - count, count )
+            edge = self.edges[ dim ][ np.repeat( ind1, count ) + step ]
+            ray_list.append( ray_ind )
+            par_list.append( ( edge - start_arr[ ray_ind, dim ] ) / delta[ ray_ind, dim ] )
+        ray_ind = np.concatenate( ray_list )
+        par = np.concatenate( par_list )
+        assert ( ( par >= 0 ) & ( par <= 1 ) ).all(), 'collision outside ray path'
+        order = np.lexsort( ( par, ray_ind, ) )
+        ray_ind = ray_ind[ order ]
+        par = par[ order ]
         
-        result = {}
-        for prev, point in zip( point_list[:-1], point_list[1:] ):
-            mid_point = Point.mid_point( prev, point )
-            co_ord = self.get_cell( mid_point )
-            #weight = point.dist( prev ) / ray.length
-            result[ co_ord ] = result.get( co_ord, 0 ) + point.dist( prev )
-        return result
+        #segments between consecutive collisions of the same ray
+        is_seg = ( ray_ind[1:] == ray_ind[:-1] )
+        seg_ray = ray_ind[:-1][ is_seg ]
+        par0 = par[:-1][ is_seg ]
+        par1 = par[1:][ is_seg ]
+        mid_point = start_arr[ seg_ray ] + ( 0.5*(par0+par1) )[:,None] * delta[ seg_ray ]
+        seg_cell = [ self.get_cell_1d_array( mid_point[:,dim], dim ) for dim in range( self.ndim ) ]
+        seg_dist = ( par1 - par0 ) * length[ seg_ray ]
+        
+        #sum segments of the same ray in the same cell
+        ncell = int( np.prod( self.shape ) )
+        key = seg_ray.astype( 'int64' ) * ncell + np.ravel_multi_index( seg_cell, self.shape )
+        key, inverse = np.unique( key, return_inverse=True )
+        dist = np.bincount( inverse, weights=seg_dist )
+        cell = np.stack( np.unravel_index( key % ncell, self.shape ), axis=1 )
+        ptr = np.searchsorted( key // ncell, np.arange( nray+1 ) )
+        return ptr, cell, dist
+    
+    def get_ray_cell_dist( self, ray ):
+        assert ray.ndim == self.ndim, 'dimension mis-match'
+        ptr, cell, dist = self.get_ray_cell_dist_batch( [ ray.start.co_ord ], [ ray.end.co_ord ] )
+        return { tuple( c ): d for c, d in zip( cell.tolist(), dist.tolist() ) }
     
     def get_weight( self, ray ):
         dist_dict = self.get_ray_cell_dist( ray )
@@ -14,6 +14,7 @@ import context
 from obs_preprocess.obs_defn import ObsInstantRay
 from obs_preprocess.model_space import ModelSpace
 import fourdvar.util.file_handle as fh
+import fourdvar.util.obs_handle as obs_handle
 import fourdvar.params.input_defn as input_defn
 
 # save new obs file as fourdvar input file
@@ -46,5 +47,5 @@ obs = ObsInstantRay.create( otime, oloc, ospc, oval, ounc, )
 obs.interp_time = ointerp
 obs.model_process( model_grid )
 obslist = [ model_grid.get_domain(), obs.get_obsdict() ]
-fh.save_list( obslist, save_file )
+obs_handle.save_list( obslist, save_file )
 print 'observations saved to {:}'.format( save_file )
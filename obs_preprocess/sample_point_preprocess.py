@@ -14,6 +14,7 @@ import context
 from obs_preprocess.obs_defn import ObsSimple
 from obs_preprocess.model_space import ModelSpace
 import fourdvar.util.file_handle as fh
+import fourdvar.util.obs_handle as obs_handle
 import fourdvar.params.input_defn as input_defn
 
 # save new obs file as fourdvar input file
@@ -39,5 +40,5 @@ for coord, val, unc in zip( obs_coord, obs_val, obs_unc ):
     obs = ObsSimple.create( coord, val, unc )
     obs.model_process( model_grid )
     obslist.append( obs.get_obsdict() )
-fh.save_list( obslist, save_file )
+obs_handle.save_list( obslist, save_file )
 print 'observations saved to {:}'.format( save_file )
@@ -0,0 +1,221 @@
+"""
+station_preprocess.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import os
+import csv
+import glob
+import itertools
+import datetime as dt
+import numpy as np
+from netCDF4 import Dataset
+
+import context
+from model_space import ModelSpace, tosec, daysec
+import fourdvar.util.obs_handle as obs_handle
+from fourdvar.params.root_path_defn import share_path
+import fourdvar.params.input_defn as input_defn
+
+#-CONFIG-SETTINGS---------------------------------------------------------
+
+#station data files, CSV (with a header line) or netCDF, patterns allowed.
+#every record (CSV row or netCDF variable index) needs the fields:
+#  site (int), lat & lon (degrees), height (m above ground),
+#  start_date & end_date (int YYYYMMDD), start_time & end_time (int HHMMSS),
+#  value & uncertainty (same units as the model concentrations)
+#records without a finite value or with an uncertainty that isn't finite & > 0 are dropped
+#an optional 'spcs' field names the species, otherwise default_spcs is used.
+source = [ os.path.join( share_path, 'obs_station_data', '*.csv' ) ]
+
+output_file = input_defn.obs_file
+
+#species observed by records without a spcs field
+default_spcs = 'CO2'
+
+#No. of records read & mapped onto the model grid at a time
+chunk_size = 1000000
+
+#--------------------------------------------------------------------------
+
+field_list = [ 'site', 'lat', 'lon', 'height', 'start_date', 'start_time',
+               'end_date', 'end_time', 'value', 'uncertainty' ]
+int_field = [ 'site', 'start_date', 'start_time', 'end_date', 'end_time' ]
+
+model_grid = ModelSpace.create_from_fourdvar()
+
+stime = tosec( model_grid.gridmeta[ 'STIME' ] )
+tsec = tosec( model_grid.gridmeta[ 'TSTEP' ] )
+#No. of steps per day (model step 1 to step_per_day of each date)
+step_per_day = daysec // tsec
+sdate = dt.datetime.strptime( str( model_grid.sdate ), '%Y%m%d' )
+edate = dt.datetime.strptime( str( model_grid.edate ), '%Y%m%d' )
+date_list = np.array( [ int( ( sdate + dt.timedelta( days=d ) ).strftime( '%Y%m%d' ) )
+                        for d in range( ( edate - sdate ).days + 1 ) ] )
+
+def read_records( fname ):
+    """read the records of a CSV or netCDF station file, chunk_size records at a time.
+    yields a dict of arrays for every chunk"""
+    if obs_handle.is_ncf( fname ):
+        with Dataset( fname, 'r' ) as f:
+            f.set_auto_mask( False )
+            name_list = [ v for v in field_list + [ 'spcs' ] if v in f.variables ]
+            missing = [ v for v in field_list if v not in name_list ]
+            assert len( missing ) == 0, '{} missing fields {}'.format( fname, missing )
+            nrec = len( f.variables[ 'value' ] )
+            for start in range( 0, nrec, chunk_size ):
+                yield { v: f.variables[ v ][ start:start+chunk_size ] for v in name_list }
+        return
+    with open( fname, 'r' ) as f:
+        reader = csv.reader( f )
+        header = [ h.strip() for h in next( reader ) ]
+        missing = [ v for v in field_list if v not in header ]
+        assert len( missing ) == 0, '{} missing fields {}'.format( fname, missing )
+        while True:
+            row_list = list( itertools.islice( reader, chunk_size ) )
+            if len( row_list ) == 0:
+                break
+            rec = {}
+            for name, column in zip( header, zip( *row_list ) ):
+                if name == 'spcs':
+                    rec[ name ] = np.array( column )
+                elif name in int_field:
+                    rec[ name ] = np.array( column, dtype='int64' )
+                elif name in field_list:
+                    rec[ name ] = np.array( column, dtype='float64' )
+            yield rec
+
+def date_to_day( date_arr ):
+    """convert an array of int YYYYMMDD into days since 1970-01-01"""
+    date_arr = np.asarray( date_arr, dtype='int64' )
+    month = 12*( date_arr//10000 - 1970 ) + ( date_arr//100 ) % 100 - 1
+    day = month.astype( 'datetime64[M]' ).astype( 'datetime64[D]' ).astype( 'int64' )
+    return day + date_arr % 100 - 1
+
+def get_step_pos( date_arr, time_arr ):
+    """position of times in model steps, step 0 is STIME of the start date"""
+    time_arr = np.asarray( time_arr, dtype='int64' )
+    sec = 3600*( time_arr//10000 ) + 60*( ( time_arr//100 ) % 100 ) + time_arr % 100
+    day = date_to_day( date_arr ) - date_to_day( [ model_grid.sdate ] )[0]
+    return ( day*daysec + sec - stime ) / float( tsec )
+
+def map_time( rec ):
+    """
+    map the time of every record onto model steps.
+    each step is an instant, the part of a record's time interval nearest to a
+    step is assigned to that step (instant records use the nearest step).
+    returns ( rec_index, date, step, proportion ) of every non-zero proportion
+    and an array of bools, True if every step of that record is in the date range.
+    """
+    pos0 = get_step_pos( rec[ 'start_date' ], rec[ 'start_time' ] )
+    pos1 = get_step_pos( rec[ 'end_date' ], rec[ 'end_time' ] )
+    valid = ( pos1 >= pos0 )
+    pos1 = np.where( valid, pos1, pos0 )
+    first = np.floor( pos0 + 0.5 ).astype( 'int64' )
+    nstep = np.floor( pos1 + 0.5 ).astype( 'int64' ) - first + 1
+
+    rec_ind = np.repeat( np.arange( pos0.size ), nstep )
+    step = np.repeat( first, nstep ) + np.arange( nstep.sum() ) - np.repeat( np.cumsum( nstep ) - nstep, nstep )
+    lower = np.maximum( pos0[ rec_ind ], step - 0.5 )
+    upper = np.minimum( pos1[ rec_ind ], step + 0.5 )
+    duration = ( pos1 - pos0 )[ rec_ind ]
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        prop = np.where( duration > 0., ( upper - lower ) / duration, 1. )
+
+    #fourdvar doesn't allow obs at step 0 (move to previous day instead)
+    day = ( step - 1 ) // step_per_day
+    step = step - day*step_per_day
+    in_range = ( day >= 0 ) & ( day < date_list.size )
+    valid &= ( np.bincount( rec_ind, weights=~in_range, minlength=pos0.size ) == 0 )
+    keep = ( prop > 0. ) & in_range
+    date = date_list[ np.clip( day, 0, date_list.size-1 ) ]
+    return ( rec_ind[ keep ], date[ keep ], step[ keep ], prop[ keep ] ), valid
+
+def map_location( rec ):
+    """map the location of every record onto model cells, returns ( lay, row, col, valid )"""
+    lat = np.asarray( rec[ 'lat' ], dtype='float64' )
+    lon = np.asarray( rec[ 'lon' ], dtype='float64' )
+    height = np.asarray( rec[ 'height' ], dtype='float64' )
+    x, y = model_grid.get_xy( lat, lon )
+    x, y = np.asarray( x ), np.asarray( y )
+    valid = model_grid.inside_xy( x, y ) & ( 0. <= height ) & ( height < model_grid.max_height )
+    col = np.zeros( lat.size, dtype='int64' )
+    row = np.zeros( lat.size, dtype='int64' )
+    lay = np.zeros( lat.size, dtype='int64' )
+    col[ valid ] = model_grid.grid.get_cell_1d_array( x[ valid ], 0 )
+    row[ valid ] = model_grid.grid.get_cell_1d_array( y[ valid ], 1 )
+    lay[ valid ] = model_grid.grid.get_cell_1d_array( height[ valid ], 2 )
+    return lay, row, col, valid
+
+def process_records( rec ):
+    """map a dict of record arrays onto the model, returns obs columns of the valid records"""
+    nrec = len( rec[ 'value' ] )
+    if 'spcs' in rec:
+        spcs = np.char.strip( np.asarray( rec[ 'spcs' ] ).astype( str ) )
+    else:
+        spcs = np.array( [ default_spcs ] * nrec )
+    value = np.asarray( rec[ 'value' ], dtype='float64' )
+    uncertainty = np.asarray( rec[ 'uncertainty' ], dtype='float64' )
+    lay, row, col, valid = map_location( rec )
+    ( rec_ind, date, step, prop ), time_valid = map_time( rec )
+    valid &= time_valid & np.in1d( spcs, model_grid.spcs )
+    #obs need a finite value and a finite, positive uncertainty
+    with np.errstate( invalid='ignore' ):
+        valid &= np.isfinite( value ) & np.isfinite( uncertainty ) & ( uncertainty > 0. )
+
+    #renumber valid records and drop the weights of invalid records
+    new_ind = np.cumsum( valid ) - 1
+    keep = valid[ rec_ind ]
+    rec_ind, date, step, prop = rec_ind[ keep ], date[ keep ], step[ keep ], prop[ keep ]
+    obs_spcs = sorted( set( spcs[ valid ] ) )
+    spc_ind = np.searchsorted( np.array( obs_spcs, dtype=spcs.dtype ), spcs )
+    weight_coord = np.stack( [ date, step, lay[ rec_ind ], row[ rec_ind ],
+                               col[ rec_ind ], spc_ind[ rec_ind ] ], axis=1 )
+    nvalid = int( valid.sum() )
+    nweight = np.bincount( new_ind[ rec_ind ], minlength=nvalid )
+    weight_ptr = np.append( 0, np.cumsum( nweight ) ).astype( 'int64' )
+
+    #lite_coord is the weight coord with the largest proportion
+    order = np.lexsort( ( -prop, rec_ind, ) )
+    lite_coord = weight_coord[ order[ weight_ptr[:-1] ] ] if nvalid > 0 else np.zeros(( 0, 6, ), dtype=int )
+
+    site = np.asarray( rec[ 'site' ] )[ valid ]
+    obs = { 'value': value[ valid ],
+            'uncertainty': uncertainty[ valid ],
+            'offset_term': np.zeros( nvalid ),
+            'lite_coord': lite_coord,
+            'spcs': obs_spcs,
+            'misc_meta': [ { 'type': 'Station', 'site': s } for s in site.tolist() ],
+            'weight_ptr': weight_ptr,
+            'weight_coord': weight_coord,
+            'weight_val': prop }
+    return obs
+
+filelist = []
+for pattern in source:
+    filelist.extend( sorted( glob.glob( pattern ) ) )
+
+domain = model_grid.get_domain()
+domain['is_lite'] = False
+writer = obs_handle.ObsWriter( output_file, domain )
+for fname in filelist:
+    nrec = 0
+    for rec in read_records( fname ):
+        obs = process_records( rec )
+        writer.append_columns( obs )
+        print 'records [{}:{}], {} valid'.format( nrec, nrec+len( rec['value'] ), len( obs['value'] ) )
+        nrec += len( rec['value'] )
+    print 'read {} records from {}'.format( nrec, fname )
+nobs = writer.close()
+
+if nobs > 0:
+    print 'recorded {} observations to {}'.format( nobs, output_file )
+else:
+    if os.path.isfile( output_file ):
+        os.remove( output_file )
+    print 'No valid observations found, no output file generated.'
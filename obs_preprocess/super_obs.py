@@ -0,0 +1,100 @@
+"""
+super_obs.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+
+import numpy as np
+
+def get_group_key( obsdict ):
+    """
+    extension: key used to group soundings into a super-observation
+    input: dict (obs dict, format from ObsGeneral.get_obsdict)
+    output: tuple ( date, step, row, col, spc )
+    """
+    date, step, lay, row, col, spc = obsdict[ 'lite_coord' ]
+    return ( date, step, row, col, spc, )
+
+def merge_obs( obs_group ):
+    """
+    extension: merge a group of obs dicts into a single super-observation
+    input: list of dicts (obs dicts)
+    output: dict (obs dict)
+
+    notes: value, offset_term & weight_grid are error-weighted averages,
+    (each obs weighted by 1/uncertainty**2, normalised to sum to 1).
+    uncertainty is that of the weighted mean ( 1/sqrt( sum(1/unc**2) ) ),
+    this assumes the errors of each obs are independent.
+    obs in the group can be super-observations themselves, merging partial
+    super-observations gives the same result as merging all their soundings.
+    a group of 1 obs gets the same fields as any other super-observation.
+    """
+    unc = np.array( [ o['uncertainty'] for o in obs_group ], dtype='float64' )
+    inv_var = 1. / unc**2
+    frac = inv_var / inv_var.sum()
+    
+    weight_grid = {}
+    for f, odict in zip( frac, obs_group ):
+        for coord, val in odict[ 'weight_grid' ].items():
+            weight_grid[ coord ] = weight_grid.get( coord, 0. ) + f*val
+    
+    lite_list = [ ( weight_grid.get( o['lite_coord'], 0. ), o['lite_coord'] ) for o in obs_group ]
+    obstype = str( obs_group[0].get( 'type', 'obs' ) )
+    if not obstype.startswith( 'super_' ):
+        obstype = 'super_' + obstype
+    result = { 'type': obstype,
+               'obs_count': sum( o.get( 'obs_count', 1 ) for o in obs_group ),
+               'value': float( ( frac * [ o['value'] for o in obs_group ] ).sum() ),
+               'offset_term': float( ( frac * [ o['offset_term'] for o in obs_group ] ).sum() ),
+               'uncertainty': float( np.sqrt( 1. / inv_var.sum() ) ),
+               'lite_coord': max( lite_list )[1],
+               'weight_grid': weight_grid }
+    return result
+
+def aggregate_obs( obslist ):
+    """
+    extension: merge obs that share a model column & timestep into super-observations
+    input: list of dicts (obs dicts, must have a lite_coord)
+    output: list of dicts (super-observations)
+
+    notes: groups are found with get_group_key, each group merged with merge_obs.
+    output order follows the first obs of each group.
+    """
+    group_dict = {}
+    key_order = []
+    for odict in obslist:
+        key = get_group_key( odict )
+        if key not in group_dict:
+            group_dict[ key ] = []
+            key_order.append( key )
+        group_dict[ key ].append( odict )
+    return [ merge_obs( group_dict[ key ] ) for key in key_order ]
+
+def add_obs( open_groups, obslist ):
+    """
+    extension: merge obs into groups that are still open to more obs
+    input: OrderedDict { group_key: dict (obs dict) }, list of dicts (obs dicts)
+    output: None (open_groups is updated)
+
+    notes: each group holds the super-observation of every obs added so far.
+    """
+    for odict in aggregate_obs( obslist ):
+        key = get_group_key( odict )
+        if key in open_groups:
+            open_groups[ key ] = merge_obs( [ open_groups[ key ], odict ] )
+        else:
+            open_groups[ key ] = odict
+    return None
+
+def pop_closed( open_groups, is_closed ):
+    """
+    extension: remove & return the finished groups
+    input: OrderedDict { group_key: dict (obs dict) }, function ( group_key -> bool )
+    output: list of dicts (super-observations, in order of their first obs)
+    """
+    closed = [ key for key in open_groups.keys() if is_closed( key ) is True ]
+    return [ open_groups.pop( key ) for key in closed ]
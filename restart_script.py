@@ -55,6 +55,8 @@ with open( log_path, ftype ) as f:
     f.write( 'restarted from iteration {}\n'.format( start_no ) )
 
 user.iter_num = start_no
+#sets the prior used to transform init_phys
+user.get_background()
 init_phys = d.PhysicalData.from_file( init_path )
 init_unk = transform( init_phys, d.UnknownData )
 init_vec = init_unk.get_vector()
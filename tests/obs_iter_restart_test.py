@@ -0,0 +1,58 @@
+"""
+obs_iter_restart_test.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+import os
+import sys
+import subprocess
+import numpy as np
+
+import context
+import fourdvar.user_driver as user
+import fourdvar.datadef as d
+import fourdvar.util.archive_handle as archive
+import fourdvar.util.obs_handle as obs_handle
+import fourdvar.params.archive_defn as archive_defn
+
+archive_defn.experiment = 'tmp_obs_iter_restart'
+archive_defn.desc_name = ''
+
+def iter_value( iteration ):
+    #values archived for each iteration (same in every process)
+    rng = np.random.RandomState( iteration )
+    return rng.normal( user.get_observed().get_vector(), 1.0 )
+
+def archive_iter( iteration_list ):
+    for i in iteration_list:
+        d.ObservationData( iter_value( i ) ).archive_iter( i )
+    return None
+
+if sys.argv[1:] == [ 'restart' ]:
+    #resume into the existing archive, as restart_script does
+    archive.archive_path = os.path.join( archive_defn.archive_path, archive_defn.experiment )
+    archive.finished_setup = True
+    archive_iter( [ 3, 4 ] )
+    sys.exit( 0 )
+
+archive_path = archive.get_archive_path()
+print 'saving results in:\n{}'.format(archive_path)
+iter_path = os.path.join( archive_path, d.ObservationData.iter_archive_name )
+
+print 'archive iterations 1 to 3'
+archive_iter( [ 1, 2, 3 ] )
+
+print 'restart from iteration 2 in a new process, archive iterations 3 & 4'
+subprocess.check_call( [ sys.executable, os.path.abspath( __file__ ), 'restart' ] )
+
+iter_num, value = obs_handle.load_obs_iter( iter_path )
+assert list( iter_num ) == [ 1, 2, 3, 4 ], 'iterations lost on restart: {}'.format( list( iter_num ) )
+for i, val in zip( iter_num, value ):
+    assert np.array_equal( val, iter_value( i ) ), 'values of iteration {} invalid'.format( i )
+lite = d.ObservationData.from_file( iter_path )
+assert lite.is_lite is True, 'iteration archive must be an obs-lite file'
+print 'passed, iterations {} archived in {}'.format( list( iter_num ), iter_path )
@@ -0,0 +1,56 @@
+"""
+obs_pool_reload_test.py
+
+Copyright 2016 University of Melbourne.
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License.
+You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and limitations under the License.
+"""
+import os
+import numpy as np
+
+import context
+import fourdvar.datadef as d
+import fourdvar.util.archive_handle as archive
+import fourdvar.util.obs_handle as obs_handle
+import fourdvar.util.parallel_handle as parallel_handle
+import fourdvar.params.archive_defn as archive_defn
+import fourdvar.params.input_defn as input_defn
+
+archive_defn.experiment = 'tmp_obs_pool_reload'
+archive_defn.desc_name = ''
+nproc = 3
+
+archive_path = archive.get_archive_path()
+print 'saving results in:\n{}'.format(archive_path)
+
+def day_weight( ymd ):
+    #total weight of each obs on day ymd, calculated from the obs in this process
+    matrix = d.ObservationData.obs_matrix[ ymd ]
+    return matrix.dot( np.ones( matrix.shape[1] ) )
+
+def check_pool():
+    ymd_list = [ ymd for ymd, ilist in d.ObservationData.ind_by_date.items()
+                 if len( ilist ) > 0 ]
+    serial = parallel_handle.pool_map( day_weight, ymd_list, nproc=1 )
+    pooled = parallel_handle.pool_map( day_weight, ymd_list, nproc=nproc )
+    for ymd, s_val, p_val in zip( ymd_list, serial, pooled ):
+        assert np.array_equal( s_val, p_val ), 'pool used stale obs for {}'.format( ymd )
+    return None
+
+print 'load {} and use a pool of {} processes'.format( input_defn.obs_file, nproc )
+d.ObservationData.from_file( input_defn.obs_file )
+check_pool()
+
+#reload a smaller set of obs while the pool exists
+domain, obs = obs_handle.load_obs( input_defn.obs_file )
+nobs = len( obs['value'] )
+subset_file = os.path.join( archive_path, 'obs_subset.nc' )
+obs_handle.save_list( [ domain ] + obs_handle.columns_to_obslist( obs, 0, max( nobs//2, 1 ) ),
+                      subset_file )
+print 'reload {} obs from {}'.format( max( nobs//2, 1 ), subset_file )
+d.ObservationData.from_file( subset_file )
+check_pool()
+parallel_handle.close_pool()
+print 'passed'
@@ -62,7 +62,7 @@ bg_path = os.path.join( archive.get_archive_path(), prior_true_archive )
 user.background = d.PhysicalData.from_file( bg_path )
 obs_path = os.path.join( archive.get_archive_path(), obs_pert_archive )
 user.observed = d.ObservationData.from_file( obs_path )
-init_vec = transform( user.background, d.UnknownData ).get_vector()
+init_vec = transform( user.get_background(), d.UnknownData ).get_vector()
 cost = main.cost_func( init_vec )
 logger.info( 'No. obs = {:}'.format( o_val.size ) )
 logger.info( 'Target cost = {:}'.format( cost ) )